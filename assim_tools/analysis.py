@@ -1,9 +1,10 @@
 import numpy as np
-from numba import njit
+from numba import njit, prange
 from utils.parallel import by_rank, bcast_by_root
 from utils.progress import print_with_cache, progress_bar
-from utils.conversion import t2h, h2t
-from .localization import local_factor
+from utils.conversion import t2h, h2t, type_convert
+from .localization import local_factor, build_obs_bins, nearby_obs
+from .transpose import wait_partition, wait_all
 # from .inflation import relax_factor
 
 ###pack/unpack local state and obs data for jitted functions:
@@ -13,11 +14,10 @@ def pack_local_state_data(c, par_id, state_prior, z_state):
 
     ##x,y coordinates for local state variables on pid
     ist,ied,di,jst,jed,dj = c.partitions[par_id]
-    ii, jj = np.meshgrid(np.arange(ist,ied,di), np.arange(jst,jed,dj))
-    msk = c.mask[jst:jed:dj, ist:ied:di]
-    data['mask'] = msk
-    data['x'] = c.grid.x[jst:jed:dj, ist:ied:di][~msk]
-    data['y'] = c.grid.y[jst:jed:dj, ist:ied:di][~msk]
+    data['mask'] = c.mask[jst:jed:dj, ist:ied:di]
+    inds = c.state_index['par_inds'][par_id]
+    data['x'] = c.grid.x.reshape(-1)[inds]
+    data['y'] = c.grid.y.reshape(-1)[inds]
 
     data['fields'] = []
     for rec_id in c.rec_list[c.pid_rec]:
@@ -30,7 +30,7 @@ def pack_local_state_data(c, par_id, state_prior, z_state):
     nloc = len(data['x'])
     data['rec_id'] = np.full(nfld, 0)
     data['t'] = np.full(nfld, np.nan)
-    data['state_prior'] = np.full((c.nens, nfld, nloc), np.nan)
+    data['state_prior'] = np.full((c.nens, nfld, nloc), np.nan, dtype=type_convert[c.state_dtype])
     data['z'] = np.zeros((nfld, nloc))
     for m in range(c.nens):
         for n in range(nfld):
@@ -38,7 +38,11 @@ def pack_local_state_data(c, par_id, state_prior, z_state):
             rec = c.state_info['fields'][rec_id]
             data['rec_id'][n] = rec_id
             data['t'][n] = t2h(rec['time'])
-            data['z'][n, :] += np.squeeze(z_state[m, rec_id][par_id][v, :]).astype(np.float32) / c.nens  ##ens mean z
+            if c.transpose_z_mean:
+                ##z_state already holds the ens mean z, indexed by rec_id only
+                data['z'][n, :] = np.squeeze(z_state[rec_id][par_id][v, :])
+            else:
+                data['z'][n, :] += np.squeeze(z_state[m, rec_id][par_id][v, :]).astype(np.float32) / c.nens  ##ens mean z
             data['state_prior'][m, n, :] = np.squeeze(state_prior[m, rec_id][par_id][v, :])
     return data
 
@@ -72,7 +76,7 @@ def pack_local_obs_data(c, par_id, lobs, lobs_prior):
     data['hroi'] = np.ones(nlobs)
     data['vroi'] = np.ones(nlobs)
     data['troi'] = np.ones(nlobs)
-    data['obs_prior'] = np.full((c.nens, nlobs), np.nan)
+    data['obs_prior'] = np.full((c.nens, nlobs), np.nan, dtype=type_convert[c.state_dtype])
     data['used'] = np.full(nlobs, False)
 
     i = 0
@@ -127,18 +131,18 @@ def batch_assim(c, state_prior, z_state, lobs, lobs_prior):
     print = by_rank(c.comm, c.pid_show)(print_with_cache)
 
     ##count number of tasks
-    ntask = 0
-    for par_id in c.par_list[c.pid_mem]:
-        ist,ied,di,jst,jed,dj = c.partitions[par_id]
-        msk = c.mask[jst:jed:dj, ist:ied:di]
-        for l in range(np.sum((~msk).astype(int))):
-            ntask += 1
+    ntask = np.sum([c.state_index['par_size'][par_id] for par_id in c.par_list[c.pid_mem]])
 
     ##now the actual work starts, loop through partitions stored on pid_mem
     print('assimilate in batch mode:\n')
+    if c.weight_interp_stride > 1 and c.batch_kernel != 'python':
+        print(f"weight_interp_stride={c.weight_interp_stride} takes precedence, batch_kernel='{c.batch_kernel}' is not used\n")
     task = 0
     for par_id in c.par_list[c.pid_mem]:
 
+        ##with nonblocking transpose, wait for the chunks of this partition to arrive
+        wait_partition(c, par_id)
+
         state_data = pack_local_state_data(c, par_id, state_prior, z_state)
 
         nens, nfld, nloc = state_data['state_prior'].shape
@@ -161,24 +165,73 @@ def batch_assim(c, state_prior, z_state, lobs, lobs_prior):
 
         impact_on_state = 1
 
-        ##loop through the unmasked grid points in the partition
-        for l in range(nloc):
+        ##bin the local obs by the max hroi, so that each grid point only searches the
+        ##obs in the neighboring bins; exp localization has no cutoff, all obs are searched
+        dbin = np.max(obs_data['hroi']) if c.localize_type in ('GC', 'step') else np.inf
+        obs_bins = build_obs_bins(obs_data['x'], obs_data['y'], dbin)
+
+        ##compute weights on a coarse stencil and interpolate them to the other grid points
+        if c.weight_interp_stride > 1:
+            nodes, stencil, wx, wy = weight_interp_stencil(c, par_id)
+            local_analysis_interp(state_data['state_prior'],
+                                  state_data['x'], state_data['y'],
+                                  state_data['z'], state_data['t'],
+                                  obs_data['obs'], obs_err,
+                                  obs_data['x'], obs_data['y'],
+                                  obs_data['z'], obs_data['t'],
+                                  obs_data['obs_prior'],
+                                  obs_data['hroi'], obs_data['vroi'],
+                                  obs_data['troi'], obs_bins,
+                                  nodes, stencil, wx, wy,
+                                  c.localize_type, c.filter_type)
+            task += nloc
+            print(progress_bar(task-1, ntask))
 
-            print(progress_bar(task, ntask))
-            task += 1
+        ##solve the local analysis for batches of grid points with stacked matrix ops
+        elif c.batch_kernel == 'blas3':
+            local_analysis_blas3(c, state_data, obs_data, obs_bins)
+            task += nloc
+            print(progress_bar(task-1, ntask))
 
-            local_analysis(state_data['state_prior'][:, :, l],
-                           state_data['x'][l], state_data['y'][l],
-                           state_data['z'][:, l], state_data['t'][:],
-                           obs_data['obs'], obs_err,
-                           obs_data['x'], obs_data['y'],
-                           obs_data['z'], obs_data['t'],
-                           obs_data['obs_prior'],
-                           obs_data['hroi'], obs_data['vroi'],
-                           obs_data['troi'], impact_on_state,
-                           c.localize_type, c.filter_type)
+        ##process all unmasked grid points in the partition in one jitted kernel
+        elif c.batch_kernel in ('jit', 'jit_parallel'):
+            kernel = local_analysis_loop_parallel if c.batch_kernel == 'jit_parallel' else local_analysis_loop
+            kernel(state_data['state_prior'],
+                   state_data['x'], state_data['y'],
+                   state_data['z'], state_data['t'],
+                   obs_data['obs'], obs_err,
+                   obs_data['x'], obs_data['y'],
+                   obs_data['z'], obs_data['t'],
+                   obs_data['obs_prior'],
+                   obs_data['hroi'], obs_data['vroi'],
+                   obs_data['troi'], obs_bins, impact_on_state,
+                   c.localize_type, c.filter_type)
+            task += nloc
+            print(progress_bar(task-1, ntask))
+        else:
+            ##loop through the unmasked grid points in the partition
+            for l in range(nloc):
+
+                print(progress_bar(task, ntask))
+                task += 1
+
+                ind = nearby_obs(state_data['x'][l], state_data['y'][l], obs_bins)
+                if ind.size == 0:
+                    continue
+
+                local_analysis(state_data['state_prior'][:, :, l],
+                               state_data['x'][l], state_data['y'][l],
+                               state_data['z'][:, l], state_data['t'][:],
+                               obs_data['obs'][ind], obs_err[ind],
+                               obs_data['x'][ind], obs_data['y'][ind],
+                               obs_data['z'][ind], obs_data['t'][ind],
+                               obs_data['obs_prior'][:, ind],
+                               obs_data['hroi'][ind], obs_data['vroi'][ind],
+                               obs_data['troi'][ind], impact_on_state,
+                               c.localize_type, c.filter_type)
 
         unpack_local_state_data(c, par_id, state_prior, state_data)
+    wait_all(c)
     print(' done.\n')
 
     return state_prior
@@ -239,8 +292,9 @@ def local_analysis(state_prior, state_x, state_y, state_z, state_t,
 
         ##limit number of local obs if needed
         ###e.g. topaz only keep the first 3000 obs with highest lfactor
-        nlobs_max = None  ##3000
-        ind = ind[:nlobs_max]
+        nlobs_max = 0  ##3000, 0 for no limit
+        if nlobs_max > 0:
+            ind = ind[:nlobs_max]
 
         ##use cached weight if no localization is applied, to avoid repeated computation
         if n>0 and len(ind)==len(lfactor_old) and (lfactor[ind]==lfactor_old).all():
@@ -255,6 +309,315 @@ def local_analysis(state_prior, state_x, state_y, state_z, state_t,
         weights_old = weights
 
 
+##compiled version of local_analysis, to be called inside the jitted loops below
+local_analysis_jit = njit(local_analysis)
+
+
+def local_analysis_loop(state_prior, state_x, state_y, state_z, state_t,
+                        obs, obs_err, obs_x, obs_y, obs_z, obs_t,
+                        obs_prior,
+                        hroi, vroi, troi, obs_bins, impact_on_state, localize_type,
+                        filter_type):
+    """
+    perform local analysis for all the nloc locations in a partition,
+    state_prior: np.array[nens, nfld, nloc], state_x/y: [nloc], state_z: [nfld, nloc],
+    obs_bins: from build_obs_bins(), only the obs in the bins near each location are used,
+    the other inputs are the same as local_analysis;
+    the locations are independent, so the loop can run in parallel with prange
+    """
+    nens, nfld, nloc = state_prior.shape
+    for l in prange(nloc):
+        ind = nearby_obs(state_x[l], state_y[l], obs_bins)
+        if ind.size == 0:
+            continue
+        local_analysis_jit(state_prior[:, :, l], state_x[l], state_y[l],
+                           state_z[:, l], state_t,
+                           obs[ind], obs_err[ind], obs_x[ind], obs_y[ind], obs_z[ind], obs_t[ind],
+                           obs_prior[:, ind],
+                           hroi[ind], vroi[ind], troi[ind], impact_on_state, localize_type,
+                           filter_type)
+
+local_analysis_loop_parallel = njit(parallel=True)(local_analysis_loop)
+local_analysis_loop = njit(local_analysis_loop)
+
+
+def weight_interp_stencil(c, par_id):
+    """
+    Coarse stencil for computing the weights in partition par_id, the stencil nodes are the
+    grid points on every c.weight_interp_stride-th row and column of the tile (and its last
+    row and column), the weights at other points are bilinearly interpolated from the 4 nodes
+    surrounding them
+
+    Returns:
+    - nodes: np.array[nnode], local indices (in state_data) of the unmasked stencil nodes
+    - stencil: np.array[nloc, 4], local indices of the (j0,i0), (j0,i1), (j1,i0), (j1,i1) nodes
+      for each point, -1 if one of them is masked, then the weights are computed exactly
+    - wx, wy: np.array[nloc], interpolation coefficients in the i and j directions
+    """
+    stride = c.weight_interp_stride
+    ist,ied,di,jst,jed,dj = c.partitions[par_id]
+    ni, nj = len(range(ist, ied, di)), len(range(jst, jed, dj))
+    inds = c.state_index['par_inds'][par_id]
+    nloc = inds.size
+    ii = (inds % c.nx - ist) // di
+    jj = (inds // c.nx - jst) // dj
+
+    ##local index for each point in the tile, -1 for masked points
+    loc = np.full((nj, ni), -1)
+    loc[jj, ii] = np.arange(nloc)
+
+    ##the surrounding nodes in each direction
+    def bracket(ind, n):
+        node = np.unique(np.append(np.arange(0, n, stride), n-1))
+        k = np.searchsorted(node, ind, side='right') - 1
+        i0 = node[k]
+        i1 = node[np.minimum(k+1, node.size-1)]
+        w = np.where(i1 > i0, (ind - i0) / np.maximum(i1 - i0, 1), 0.)
+        return i0, i1, w
+    i0, i1, wx = bracket(ii, ni)
+    j0, j1, wy = bracket(jj, nj)
+
+    stencil = np.stack([loc[j0, i0], loc[j0, i1], loc[j1, i0], loc[j1, i1]], axis=1)
+    stencil[(stencil < 0).any(axis=1), :] = -1
+    nodes = np.unique(stencil[stencil >= 0])
+    return nodes, stencil, wx, wy
+
+
+@njit
+def local_lfactor(state_x, state_y, state_z, state_t,
+                  obs_x, obs_y, obs_z, obs_t, hroi, vroi, troi, localize_type):
+    """
+    Localization factors of the obs for one field at one location, the same as in local_analysis
+    """
+    lfactor = local_factor(np.hypot(obs_x - state_x, obs_y - state_y), hroi, localize_type)
+    lfactor *= local_factor(np.abs(obs_z - state_z), vroi, localize_type)
+    lfactor *= local_factor(np.abs(obs_t - state_t), troi, localize_type)
+    return lfactor
+
+
+@njit
+def local_weights(obs, obs_err, obs_prior, lfactor, filter_type):
+    """
+    Transform weights for one field at one location, given the lfactor from local_lfactor()
+
+    Return:
+    - weights: np.array[nens, nens]
+    - updated: bool, False if no obs has impact on the location (weights is identity)
+    """
+    nens = obs_prior.shape[0]
+    ind = np.where(lfactor>0)[0]
+    if ind.size == 0:
+        return np.eye(nens), False
+
+    ##sort the obs from high to low lfactor
+    ind = ind[np.argsort(lfactor[ind])[::-1]]
+    return ensemble_transform_weights(obs[ind], obs_err[ind], obs_prior[:, ind], filter_type, lfactor[ind]), True
+
+
+@njit
+def local_analysis_interp(state_prior, state_x, state_y, state_z, state_t,
+                          obs, obs_err, obs_x, obs_y, obs_z, obs_t,
+                          obs_prior, hroi, vroi, troi, obs_bins,
+                          nodes, stencil, wx, wy, localize_type, filter_type):
+    """
+    perform local analysis for all the nloc locations in a partition, with the weights
+    computed at the stencil nodes and interpolated to the other locations
+    (nodes, stencil, wx, wy from weight_interp_stencil(), the other inputs are the same as local_analysis_loop)
+
+    The lfactor of each node is kept, if it is unchanged for the next field (same level,
+    or no vertical localization) the node weights are reused, as lfactor_old in local_analysis.
+    """
+    nens, nfld, nloc = state_prior.shape
+    slot = np.full(nloc, -1)
+    for k in range(nodes.size):
+        slot[nodes[k]] = k
+    node_weights = np.zeros((nodes.size, nens, nens))
+    node_updated = np.zeros(nodes.size, dtype=np.bool_)
+    node_lfactor = [np.zeros(0) for _ in range(nodes.size)]
+    fac = np.zeros(4)
+
+    for n in range(nfld):
+        ##weights at the stencil nodes for field n
+        for k in range(nodes.size):
+            l = nodes[k]
+            ind = nearby_obs(state_x[l], state_y[l], obs_bins)
+            lfactor = local_lfactor(state_x[l], state_y[l], state_z[n, l], state_t[n],
+                                    obs_x[ind], obs_y[ind], obs_z[ind], obs_t[ind],
+                                    hroi[ind], vroi[ind], troi[ind], localize_type)
+            if n > 0 and lfactor.size == node_lfactor[k].size and (lfactor == node_lfactor[k]).all():
+                continue
+            node_lfactor[k] = lfactor
+            node_weights[k], node_updated[k] = local_weights(obs[ind], obs_err[ind], obs_prior[:, ind], lfactor, filter_type)
+
+        for l in range(nloc):
+            ##if prior spread is zero, don't update
+            if np.std(state_prior[:, n, l]) == 0:
+                continue
+
+            if stencil[l, 0] < 0:
+                ##a stencil node is masked, compute the weights exactly
+                ind = nearby_obs(state_x[l], state_y[l], obs_bins)
+                lfactor = local_lfactor(state_x[l], state_y[l], state_z[n, l], state_t[n],
+                                        obs_x[ind], obs_y[ind], obs_z[ind], obs_t[ind],
+                                        hroi[ind], vroi[ind], troi[ind], localize_type)
+                weights, updated = local_weights(obs[ind], obs_err[ind], obs_prior[:, ind], lfactor, filter_type)
+            else:
+                ##bilinear interpolation of the node weights
+                fac[0] = (1 - wx[l]) * (1 - wy[l])
+                fac[1] = wx[l] * (1 - wy[l])
+                fac[2] = (1 - wx[l]) * wy[l]
+                fac[3] = wx[l] * wy[l]
+                weights = np.zeros((nens, nens))
+                updated = False
+                for s in range(4):
+                    k = slot[stencil[l, s]]
+                    weights += fac[s] * node_weights[k]
+                    updated = updated or (node_updated[k] and fac[s] > 0)
+
+            if updated:
+                state_prior[:, n, l] = apply_ensemble_transform(state_prior[:, n, l], weights)
+
+
+def local_analysis_blas3(c, state_data, obs_data, obs_bins):
+    """
+    perform local analysis for all the grid points in a partition, in batches of grid
+    points sized to fit c.blas3_batch_mem (MB): the (S, dy) problems for all the points
+    and fields in a batch are stacked (padded with zeros to the max number of local obs)
+    and solved by batch_transform_weights(), the state_data['state_prior'] is updated in place
+
+    Fields of a point with identical localization factors (same level, or no vertical
+    localization) share one problem, as lfactor_old in local_analysis, and the weights
+    are applied to each of them.
+    """
+    state_prior = state_data['state_prior']
+    nens, nfld, nloc = state_prior.shape
+    obs_err = obs_data['err_std']
+    obs_prior_mean = np.mean(obs_data['obs_prior'], axis=0)
+    obs_prior_pert = (obs_data['obs_prior'] - obs_prior_mean).T  ##[nlobs, nens]
+    innov = obs_data['obs'] - obs_prior_mean
+
+    l1 = 0
+    while l1 < nloc:
+        ##local obs of each point, add points to the batch until the estimated memory
+        ##of the localization factors, S and the weights exceeds c.blas3_batch_mem
+        l0 = l1
+        ind_list = []
+        nlobs_max = 0
+        while l1 < nloc:
+            ind_l = nearby_obs(state_data['x'][l1], state_data['y'][l1], obs_bins)
+            nlobs = max(nlobs_max, ind_l.size)
+            nbytes = 8 * (len(ind_list)+1) * nfld * (4*nlobs + 2*nlobs*nens + 6*nens*nens)
+            if ind_list and nbytes > c.blas3_batch_mem * 2**20:
+                break
+            ind_list.append(ind_l)
+            nlobs_max = nlobs
+            l1 += 1
+        if nlobs_max == 0:
+            continue
+        npt = l1 - l0
+        ind = np.zeros((npt, nlobs_max), dtype=int)
+        valid = np.zeros((npt, nlobs_max), dtype=bool)
+        for i, ind_l in enumerate(ind_list):
+            ind[i, :ind_l.size] = ind_l
+            valid[i, :ind_l.size] = True
+
+        ##localization factors [npt, nfld, nlobs_max]
+        h_dist = np.hypot(obs_data['x'][ind] - state_data['x'][l0:l1, None], obs_data['y'][ind] - state_data['y'][l0:l1, None])
+        v_dist = np.abs(obs_data['z'][ind][:, None, :] - state_data['z'][:, l0:l1].T[:, :, None])
+        t_dist = np.abs(obs_data['t'][ind][:, None, :] - state_data['t'][None, :, None])
+        shape = v_dist.shape
+        vroi = np.broadcast_to(obs_data['vroi'][ind][:, None, :], shape)
+        troi = np.broadcast_to(obs_data['troi'][ind][:, None, :], shape)
+        lfactor = local_factor(h_dist.ravel(), obs_data['hroi'][ind].ravel(), c.localize_type).reshape(h_dist.shape)
+        lfactor = (lfactor * valid)[:, None, :] * local_factor(v_dist.ravel(), vroi.ravel(), c.localize_type).reshape(shape)
+        lfactor *= local_factor(t_dist.ravel(), troi.ravel(), c.localize_type).reshape(shape)
+
+        ##only solve for the (point, field) with local obs and nonzero prior spread
+        ens = state_prior[:, :, l0:l1].transpose((2, 1, 0))  ##[npt, nfld, nens]
+        active = (lfactor > 0).any(axis=2) & (np.std(ens, axis=2) > 0)
+        pt, n = np.where(active)
+        if pt.size == 0:
+            continue
+
+        ##one problem for each distinct lfactor row of a point, prob[pt, n] is the
+        ##problem that (pt, n) uses
+        prob = np.zeros((npt, nfld), dtype=int)
+        prob_pt, prob_lf = [], []
+        for i in np.unique(pt):
+            flds = np.where(active[i])[0]
+            rows, inv = np.unique(lfactor[i, flds], axis=0, return_inverse=True)
+            prob[i, flds] = len(prob_pt) + inv.reshape(-1)
+            prob_pt += [i] * len(rows)
+            prob_lf.append(rows)
+        prob_pt = np.array(prob_pt)
+
+        ##normalized obs prior perturbations S and innovations dy
+        lf = np.concatenate(prob_lf) / obs_err[ind[prob_pt]] / np.sqrt(nens-1)
+        S = obs_prior_pert[ind[prob_pt]] * lf[:, :, None]   ##[nprob, nlobs_max, nens]
+        dy = innov[ind[prob_pt]] * lf                       ##[nprob, nlobs_max]
+
+        weights = batch_transform_weights(S, dy, c.filter_type)
+
+        ##apply the weights, ens_post[m] = sum(ens_prior * weights[:, m])
+        state_prior[:, n, l0+pt] = np.einsum('bi,bij->jb', ens[pt, n, :].astype(np.float64), weights[prob[pt, n]])
+
+
+def batch_transform_weights(S, dy, filter_type):
+    """
+    Stacked version of ensemble_transform_weights
+
+    Inputs:
+    - S: np.array[nprob, nlobs, nens]
+      The normalized obs prior perturbations for each problem (padded with zeros)
+
+    - dy: np.array[nprob, nlobs]
+      The normalized innovations
+
+    - filter_type: str
+      "ETKF" or "DEnKF"
+
+    Return:
+    - weights: np.array[nprob, nens, nens]
+    """
+    nprob, nlobs, nens = S.shape
+    ST = S.transpose((0, 2, 1))
+    I = np.eye(nens)
+
+    ##same as ensemble_transform_weights, eigh in the smaller of the nlobs- and nens-sized spaces
+    try:
+        if nlobs < nens:
+            mu, U = np.linalg.eigh(S @ ST)
+            mu = np.maximum(mu, 0.)
+            STU = ST @ U
+            gain = (STU / (1. + mu[:, None, :])) @ U.transpose((0, 2, 1))
+            mu_sqrt = np.sqrt(1. + mu)
+            var_ratio_sqrt = I - (STU / (mu_sqrt * (1. + mu_sqrt))[:, None, :]) @ STU.transpose((0, 2, 1))
+        else:
+            lam, V = np.linalg.eigh(I + ST @ S)
+            VT = V.transpose((0, 2, 1))
+            gain = (V / lam[:, None, :]) @ VT @ ST
+            var_ratio_sqrt = (V / np.sqrt(lam)[:, None, :]) @ VT
+
+    except np.linalg.LinAlgError:
+        ##one ill-conditioned problem fails the stacked eigh of the whole batch, solve the two halves
+        ##separately until it is isolated, then it gets equal weights (no update) as in ensemble_transform_weights
+        if nprob == 1:
+            print('failed to invert var_ratio_inv for nlobs=', nlobs)
+            return I[None, :, :].copy()
+        h = nprob // 2
+        return np.concatenate([batch_transform_weights(S[:h], dy[:h], filter_type),
+                               batch_transform_weights(S[h:], dy[h:], filter_type)])
+
+    if filter_type == 'DEnKF':
+        var_ratio_sqrt = I - 0.5 * gain @ S
+    elif filter_type != 'ETKF':
+        raise ValueError('unknown filter type: '+filter_type)
+
+    ##the mean update goes to every column
+    mean_weights = np.einsum('bij,bj->bi', gain, dy)
+    return var_ratio_sqrt + mean_weights[:, :, None]
+
+
 @njit
 def ensemble_transform_weights(obs, obs_err, obs_prior, filter_type, local_factor):
     """
@@ -304,40 +667,52 @@ def ensemble_transform_weights(obs, obs_err, obs_prior, filter_type, local_facto
     S /= np.sqrt(nens-1)
     dy /= np.sqrt(nens-1)
 
-    ##find singular values of the inverse variance ratio matrix (I + S^T S)
+    ##symmetric eigendecomposition of the inverse variance ratio matrix (I + S^T S),
     ##note: the added I actually helps prevent issues if S^T S is not full rank
-    ##      when nlobs<nens, there will be singular values of 0, but the full matrix
-    ##      can still be inverted with singular values of 1.
-    var_ratio_inv = np.eye(nens) + S.T @ S
+    ##when nlobs<nens, the smaller nlobs-sized matrix S S^T is decomposed instead,
+    ##with S S^T = U diag(mu) U^T, S^T S has the same nonzero eigenvalues mu
+    try:
+        if nlobs < nens:
+            mu, U = np.linalg.eigh(S @ S.T)
+            mu = np.maximum(mu, 0.)  ##remove negative round-off errors
+            STU = S.T @ U
 
-    ##TODO: var_ratio_inv = np.eye(nlobs) + S @ S.T  if nlobs<nens
+            ##the gain matrix (I + S^T S)^-1 S^T = S^T (I + S S^T)^-1
+            gain = (STU / (1. + mu)) @ U.T
 
-    try:
-        L, sv, Rh = np.linalg.svd(var_ratio_inv)
-    except:
-        ##if svd failed just return equal weights (no update)
-        print('failed to invert var_ratio_inv=', var_ratio_inv)
-        return np.eye(nens)
+            ##(I + S^T S)^-0.5 = I + S^T U diag(((1+mu)^-0.5 - 1) / mu) U^T S,
+            ##the diag is written as -1/(sqrt(1+mu)*(1+sqrt(1+mu))) to be stable for mu=0
+            mu_sqrt = np.sqrt(1. + mu)
+            var_ratio_sqrt = np.eye(nens) - (STU / (mu_sqrt * (1. + mu_sqrt))) @ STU.T
 
-    ##the update of ens mean is given by (I + S^T S)^-1 S^T dy
-    ##namely, var_ratio * obs_prior_var / obs_var * dy = G dy
-    var_ratio = L @ np.diag(sv**-1) @ Rh
+        else:
+            lam, V = np.linalg.eigh(np.eye(nens) + S.T @ S)
 
-    ##the gain matrix
-    gain = var_ratio @ S.T
+            ##the update of ens mean is given by (I + S^T S)^-1 S^T dy
+            ##namely, var_ratio * obs_prior_var / obs_var * dy = G dy
+            var_ratio = (V / lam) @ V.T
 
-    for m in range(nens):
-        weights[m, :] = np.sum(gain[m, :] * dy)
+            ##the gain matrix
+            gain = var_ratio @ S.T
+
+            ##the update of ens pert is (I + S^T S)^-0.5, namely sqrt(var_ratio)
+            var_ratio_sqrt = (V / np.sqrt(lam)) @ V.T
+
+    except:
+        ##if eigh failed just return equal weights (no update)
+        print('failed to invert var_ratio_inv for nlobs=', nlobs)
+        return np.eye(nens)
 
-    if filter_type == 'ETKF':
-        ##the update of ens pert is (I + S^T S)^-0.5, namely sqrt(var_ratio)
-        var_ratio_sqrt = L @ np.diag(sv**-0.5) @ Rh
+    mean_weights = gain @ dy
+    for m in range(nens):
+        weights[m, :] = mean_weights[m]
 
-    elif filter_type == 'DEnKF':
+    ##for ETKF, the pert update is the var_ratio_sqrt found above
+    if filter_type == 'DEnKF':
         ##take Taylor approx. of var_ratio_sqrt (Sakov 2008)
         var_ratio_sqrt = np.eye(nens) - 0.5 * gain @ S
 
-    else:
+    elif filter_type != 'ETKF':
         print('Error: unknown filter type: '+filter_type)
         raise ValueError
 
@@ -376,6 +751,7 @@ def serial_assim(c, state_prior, z_state, lobs, lobs_prior):
     print = by_rank(c.comm, c.pid_show)(print_with_cache)
     par_id = c.pid_mem
 
+    wait_all(c)
     state_data = pack_local_state_data(c, par_id, state_prior, z_state)
     nens, nfld, nloc = state_data['state_prior'].shape
 
@@ -487,6 +863,9 @@ def obs_increment(obs_prior, obs, obs_err, filter_type):
     """
     nens = obs_prior.size
 
+    ##statistics are computed in double precision, even if the state is in single precision
+    obs_prior = obs_prior.astype(np.float64)
+
     ##obs error variance
     obs_var = obs_err**2
 
@@ -589,7 +968,8 @@ def update_ensemble(ens_prior, obs_prior, obs_incr, local_factor, regress_type):
     nens = ens_prior.shape[0]
     ens_post = ens_prior.copy()
 
-    ##obs-space statistics
+    ##obs-space statistics, in double precision
+    obs_prior = obs_prior.astype(np.float64)
     obs_prior_mean = np.mean(obs_prior)
     obs_prior_var = np.sum((obs_prior - obs_prior_mean)**2) / (nens-1)
 
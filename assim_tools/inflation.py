@@ -3,7 +3,7 @@ import os
 from utils.parallel import by_rank
 from utils.conversion import type_convert, type_dic, type_size, t2h, h2t, t2s, s2t
 from utils.progress import print_with_cache, progress_bar
-from .state import read_field
+from .state import open_state_file, read_field
 
 def inflate_state(c, fields, mean_file):
 
@@ -19,18 +19,22 @@ def inflate_state(c, fields, mean_file):
     nm = len(c.mem_list[c.pid_mem])
     nr = len(c.rec_list[c.pid_rec])
 
+    f = open_state_file(mean_file, c.state_info)
+
     for r, rec_id in enumerate(c.rec_list[c.pid_rec]):
         rec = c.state_info['fields'][rec_id]
 
         ##read the mean field with rec_id
-        fields_mean = read_field(mean_file, c.state_info, c.mask, 0, rec_id)
+        fields_mean = read_field(f, c.state_info, c.mask, 0, rec_id, c.state_dtype, c.state_index['inds'])
 
         for m, mem_id in enumerate(c.mem_list[c.pid_mem]):
             if c.debug:
                 print(progress_bar(m*nr+r, nm*nr))
 
             ##inflate the ensemble perturbations by c.inflate_coef
-            fields[mem_id, rec_id] = c.inflate_coef*(fields[mem_id, rec_id] - fields_mean) + fields_mean
+            ##(cast back since an adaptive np.float64 coef promotes 'float' fields to double)
+            fld = c.inflate_coef*(fields[mem_id, rec_id] - fields_mean) + fields_mean
+            fields[mem_id, rec_id] = fld.astype(type_convert[c.state_dtype], copy=False)
 
     if c.debug:
         print(' done.\n')
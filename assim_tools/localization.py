@@ -47,3 +47,69 @@ def local_factor(dist, roi, localize_type='GC'):
 
     return lfactor.reshape(shape)
 
+
+
+###spatial search for local obs:
+@njit
+def build_obs_bins(obs_x, obs_y, dbin):
+    """
+    Sort the obs into a uniform grid of square bins, so that the obs within
+    distance dbin of a location can be found by searching the 3x3 neighboring bins
+
+    Inputs:
+    - obs_x, obs_y: np.array[nlobs]
+      Horizontal coordinates of the obs
+
+    - dbin: float
+      Bin size, the maximum search radius (max hroi), np.inf to put all obs in one bin
+
+    Return:
+    - obs_bins: tuple(x0, y0, dbin, nbx, nby, bin_start, bin_obs)
+      The bins are indexed by ib = iy*nbx + ix, the obs in bin ib are
+      bin_obs[bin_start[ib]:bin_start[ib+1]] in ascending order
+    """
+    x0 = np.min(obs_x)
+    y0 = np.min(obs_y)
+    nbx = int((np.max(obs_x) - x0) // dbin) + 1
+    nby = int((np.max(obs_y) - y0) // dbin) + 1
+    ix = ((obs_x - x0) // dbin).astype(np.int64)
+    iy = ((obs_y - y0) // dbin).astype(np.int64)
+    bin_id = iy * nbx + ix
+    bin_obs = np.argsort(bin_id, kind='mergesort')  ##stable sort keeps obs order within bins
+    bin_start = np.searchsorted(bin_id[bin_obs], np.arange(nbx*nby+1))
+    return x0, y0, dbin, nbx, nby, bin_start, bin_obs
+
+
+@njit
+def nearby_obs(x, y, obs_bins):
+    """
+    Find the obs in the 3x3 bins around location x, y
+
+    Inputs:
+    - x, y: float
+      The location
+
+    - obs_bins: tuple from build_obs_bins()
+
+    Return:
+    - ind: np.array
+      Indices of the obs in ascending order, including all obs within distance dbin
+    """
+    x0, y0, dbin, nbx, nby, bin_start, bin_obs = obs_bins
+    ix = int((x - x0) // dbin) if dbin < np.inf else 0
+    iy = int((y - y0) // dbin) if dbin < np.inf else 0
+    ix_list = range(max(ix-1, 0), min(ix+2, nbx))
+    iy_list = range(max(iy-1, 0), min(iy+2, nby))
+
+    n = 0
+    for j in iy_list:
+        for i in ix_list:
+            n += bin_start[j*nbx+i+1] - bin_start[j*nbx+i]
+    ind = np.empty(n, dtype=np.int64)
+    n = 0
+    for j in iy_list:
+        for i in ix_list:
+            d = bin_start[j*nbx+i+1] - bin_start[j*nbx+i]
+            ind[n:n+d] = bin_obs[bin_start[j*nbx+i]:bin_start[j*nbx+i+1]]
+            n += d
+    return np.sort(ind)
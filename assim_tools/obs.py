@@ -131,7 +131,7 @@ def read_mean_z_coords(c, time):
         rec_id = [i for i,r in c.state_info['fields'].items() if r['time']==time and r['k']==k_list[k]][0]
 
         ##read the z field with (mem_id=0, rec_id) from z_file
-        z_fld = read_field(z_file, c.state_info, c.mask, 0, rec_id)
+        z_fld = read_field(z_file, c.state_info, c.mask, 0, rec_id, inds=c.state_index['inds'])
 
         ##assign the coordinates to z(k)
         if c.state_info['fields'][rec_id]['is_vector']:
@@ -227,8 +227,7 @@ def distribute_partitions(c):
     if c.assim_mode == 'batch':
         ##distribute the list of par_id according to workload to each pid
         ##number of unmasked grid points in each tile
-        nlpts_loc = np.array([np.sum((~c.mask[jst:jed:dj, ist:ied:di]).astype(int))
-                              for ist,ied,di,jst,jed,dj in c.partitions] )
+        nlpts_loc = np.array([c.state_index['par_size'][p] for p in par_list_full])
 
         ##number of observations within the hroi of each tile, at loc,
         ##sum over the len of obs_inds for obs_rec_id over all obs_rec_ids
@@ -379,10 +378,13 @@ def state_to_obs(c, **kwargs):
     obs_z = np.array(kwargs['z'])
     nobs = len(obs_x)
 
+    ##obs priors are stored with the same dtype as the state,
+    ##the actual (synthetic) obs always in double precision
+    dtype = np.float64 if synthetic else type_convert[c.state_dtype]
     if is_vector:
-        seq = np.full((2, nobs), np.nan)
+        seq = np.full((2, nobs), np.nan, dtype=dtype)
     else:
-        seq = np.full(nobs, np.nan)
+        seq = np.full(nobs, np.nan, dtype=dtype)
 
     ##obs dataset source module
     obs_src = importlib.import_module('dataset.'+kwargs['dataset_src'])
@@ -422,8 +424,8 @@ def state_to_obs(c, **kwargs):
 
                 else:  ##option 1.2: read field from state binfile
                     path = os.path.join(c.work_dir,'cycle',t2s(time),'analysis',c.s_dir)
-                    z = read_field(os.path.join(path,'/z_coords.bin'), c.state_info, c.mask, 0, rec_id)
-                    fld = read_field(os.path.join(path,'/prior_state.bin'), c.state_info, c.mask, mem_id, rec_id)
+                    z = read_field(os.path.join(path,'/z_coords.bin'), c.state_info, c.mask, 0, rec_id, c.state_dtype, c.state_index['inds'])
+                    fld = read_field(os.path.join(path,'/prior_state.bin'), c.state_info, c.mask, mem_id, rec_id, c.state_dtype, c.state_index['inds'])
 
             else:  ##option 1.3: get the field from model.read_var
                 if synthetic:
@@ -1,11 +1,14 @@
 import numpy as np
 import os
-import struct
+import json
+import zlib
 import importlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 from utils.conversion import type_convert, type_dic, type_size, t2h, h2t, t2s, s2t, dt1h
 from utils.progress import print_with_cache, progress_bar
-from utils.parallel import distribute_tasks, bcast_by_root, by_rank
+from utils.parallel import distribute_tasks, bcast_by_root, by_rank, mpi_comm
 
 """
 Note: The analysis is performed on a regular grid.
@@ -38,6 +41,7 @@ def parse_state_info(c):
     rec_id = 0   ##record id for a 2D field
     pos = 0      ##seek position for rec
     variables = set()
+    fld_size = np.sum(~c.mask)  ##number of unmasked grid points
 
     ##loop through variables in state_def
     for vrec in c.state_def:
@@ -68,7 +72,6 @@ def parse_state_info(c):
 
                     ##update seek position
                     nv = 2 if rec['is_vector'] else 1
-                    fld_size = np.sum((~c.mask).astype(int))
                     pos += nv * fld_size * type_size[rec['dtype']]
                     rec_id += 1
 
@@ -94,38 +97,123 @@ def parse_state_info(c):
     return info
 
 
-def write_state_info(binfile, info):
+##version of the state file header, increase if the header content changes
+state_info_version = 1
+
+
+def mask_checksum(mask):
     """
-    Write state_info to a .dat file accompanying the .bin file
+    Checksum of the mask, to check if a state file is read with the same mask
+    that it is written with (the masked points are not stored in the file)
+    """
+    return zlib.crc32(np.packbits(mask)) ^ zlib.crc32(np.array(mask.shape, dtype=np.int64))
+
+
+def write_state_info(binfile, info, mask, nens, **kwargs):
+    """
+    Write state_info to a .json header file accompanying the .bin file
+
+    The header is self-describing: besides the field records, it contains the
+    dtype, byte offset ('pos') and length ('nbytes') of each record, the
+    stride between members ('size'), the number of members and a checksum of
+    the mask, so that a single record can be located without any other info.
 
     Inputs:
     - binfile: str
       File path for the .bin file
 
     - info: state_info
+
+    - mask: bool, np.array with shape (ny, nx)
+      The mask used in writing the .bin file
+
+    - nens: int
+      Number of members stored in the .bin file
+
+    - **kwargs
+      Additional entries for the header, e.g. the compression settings
     """
-    with open(binfile.replace('.bin','.dat'), 'wt') as f:
-        ##first line: some dimension sizes
-        f.write('{} {} {}\n'.format(info['nx'], info['ny'], info['size']))
-
-        ##followed by nfield lines: each for a field record
-        for i, rec in info['fields'].items():
-            name = rec['name']
-            model_src = rec['model_src']
-            dtype = rec['dtype']
-            is_vector = int(rec['is_vector'])
-            units = rec['units']
-            err_type = rec['err_type']
-            time = t2h(rec['time'])
-            dt = rec['dt']
-            k = rec['k']
-            pos = rec['pos']
-            f.write('{} {} {} {} {} {} {} {} {} {}\n'.format(name, model_src, dtype, is_vector, units, err_type, time, dt, k, pos))
+    fld_size = int(np.sum(~mask))
+    header = {'version': state_info_version,
+              'nx': info['nx'],
+              'ny': info['ny'],
+              'size': info['size'],
+              'nens': nens,
+              'fld_size': fld_size,
+              'mask_checksum': mask_checksum(mask),
+              **kwargs,
+              'fields': [], }
+
+    for rec_id, rec in info['fields'].items():
+        nv = 2 if rec['is_vector'] else 1
+        header['fields'].append({'rec_id': rec_id,
+                                 'name': rec['name'],
+                                 'model_src': rec['model_src'],
+                                 'dtype': rec['dtype'],
+                                 'is_vector': rec['is_vector'],
+                                 'units': rec['units'],
+                                 'err_type': rec['err_type'],
+                                 'time': t2h(rec['time']),
+                                 'dt': rec['dt'],
+                                 'k': rec['k'],
+                                 'pos': rec['pos'],
+                                 'nbytes': nv * fld_size * type_size[rec['dtype']], })
+
+    with open(binfile.replace('.bin','.json'), 'wt') as f:
+        ##numpy scalars (k, etc.) are converted to python types
+        json.dump(header, f, default=lambda x: x.item())
 
 
 def read_state_info(binfile):
+    """
+    Read .json header file accompanying the .bin file and obtain state_info
+
+    For files written by older versions, the .dat text file is read instead.
+
+    Input:
+    - binfile: str
+      File path for the .bin file
+
+    Returns:
+    - info: state_info dict
+      Besides the usual keys, 'nens', 'fld_size', 'mask_checksum', 'compress' are
+      also given (except for old .dat files), and each record has its 'nbytes'
+    """
+    header = read_header(binfile)
+    if header is None:
+        return read_state_info_dat(binfile)
+
+    info = {key: header[key] for key in ('nx', 'ny', 'size', 'nens', 'fld_size', 'mask_checksum')}
+    info['compress'] = header.get('compress', 'none')
+    info['fields'] = {}
+    for rec in header['fields']:
+        rec_id = rec.pop('rec_id')
+        rec['time'] = h2t(rec['time'])
+        info['fields'][rec_id] = rec
+
+    return info
+
+
+def read_header(binfile):
+    """
+    Load the .json header accompanying the .bin file as a dict,
+    returns None if there is no header (old files with .dat)
+    """
+    header_file = binfile.replace('.bin','.json')
+    if not os.path.exists(header_file):
+        return None
+
+    with open(header_file, 'r') as f:
+        header = json.load(f)
+    assert header['version'] <= state_info_version, f"unknown state file version {header['version']} in {header_file}"
+
+    return header
+
+
+def read_state_info_dat(binfile):
     """
     Read .dat file accompanying the .bin file and obtain state_info
+    (the text format used before the .json header)
 
     Input:
     - binfile: str
@@ -160,9 +248,10 @@ def read_state_info(binfile):
     return info
 
 
-def write_field(binfile, info, mask, mem_id, rec_id, fld):
+def open_state_file(binfile, info, mode='r', nens=None):
     """
-    Write a field to a binary file
+    Memory-map a binary state file, so that records can be accessed as
+    array slices without copying through python objects
 
     Inputs:
     - binfile: str
@@ -170,6 +259,190 @@ def write_field(binfile, info, mask, mem_id, rec_id, fld):
 
     - info: state_info dict
 
+    - mode: str, optional
+      'r' read-only (default), 'r+' read and write an existing file,
+      'w+' create (or overwrite) the file with size for nens members
+
+    - nens: int, optional
+      Number of members stored in the file, needed for mode='w+';
+      if not given, it is inferred from the file size
+
+    Returns:
+    - f: np.memmap with shape [nens, info['size']]
+      The file content as bytes, member mem_id is stored in f[mem_id, :] and
+      a field record starts at f[mem_id, rec['pos']]. Since records can have
+      different dtypes, the typed view of a record is obtained by field_view()
+
+      If the file is written with compressed records (see write_fields_compressed),
+      a CompressedStateFile is returned instead, which can only be read.
+    """
+    if mode != 'w+':
+        header = read_header(binfile)
+        if header is not None and header.get('compress', 'none') != 'none':
+            assert mode == 'r', f'{binfile} has compressed records, it can only be opened for reading'
+            return CompressedStateFile(binfile, header)
+
+    if nens is None:
+        assert mode != 'w+', 'nens is needed to create a new state file'
+        nens = os.path.getsize(binfile) // info['size']
+    return np.memmap(binfile, dtype=np.uint8, mode=mode, shape=(nens, info['size']))
+
+
+def field_view(f, info, mem_id, rec_id, fld_size):
+    """
+    Typed view of a field record in a memory-mapped state file
+
+    Inputs:
+    - f: np.memmap from open_state_file()
+
+    - info: state_info dict
+
+    - mem_id: int
+      Member index from 0 to nens-1
+
+    - rec_id: int
+      Field record index, info['fields'][rec_id] gives the record information
+
+    - fld_size: int
+      Number of unmasked grid points in the field
+
+    Returns:
+    - fld_: np.array with shape [nv, fld_size]
+      View (no copy) of the stored values of the record, nv=2 for vector fields
+    """
+    rec = info['fields'][rec_id]
+    nv = 2 if rec['is_vector'] else 1
+    nbytes = nv * fld_size * type_size[rec['dtype']]
+    return f[mem_id, rec['pos']:rec['pos']+nbytes].view(type_convert[rec['dtype']]).reshape((nv, fld_size))
+
+
+def bitround(fld_, keepbits):
+    """
+    Round the float values to keep only the first keepbits bits of the mantissa,
+    the trailing zero bits make the data much more compressible (lossy)
+
+    Inputs:
+    - fld_: np.array, float32 or float64
+
+    - keepbits: int
+      Number of mantissa bits to keep, if 0 or more than available, no rounding is done
+
+    Returns:
+    - fld_: np.array, rounded to nearest with the trailing mantissa bits set to zero
+    """
+    nbits, uint = {4:(23, np.uint32), 8:(52, np.uint64)}[fld_.dtype.itemsize]
+    if keepbits <= 0 or keepbits >= nbits:
+        return fld_
+    drop = nbits - keepbits
+    half = uint(1 << (drop-1))
+    mask = uint(~((1 << drop) - 1) & np.iinfo(uint).max)
+    b = fld_.view(uint)
+    return ((b + half) & mask).view(fld_.dtype)
+
+
+def compress_record(fld_, dtype, compress, keepbits=0):
+    """
+    Compress the stored values of a field record
+
+    Inputs:
+    - fld_: np.array
+      Values at the unmasked points of a field, [nv, fld_size]
+
+    - dtype: str
+      The dtype ('float' or 'double') to store the values in
+
+    - compress: str
+      Compression method, 'zlib'
+
+    - keepbits: int, optional
+      If >0, the mantissa is rounded to keepbits bits (lossy) before compression
+
+    Returns:
+    - chunk: bytes
+    """
+    fld_ = bitround(np.ascontiguousarray(fld_, dtype=type_convert[dtype]), keepbits)
+
+    ##byte shuffle: group the i-th bytes of all values together, the exponent and leading
+    ##mantissa bytes are similar for neighboring values, so they compress better
+    buf = fld_.view(np.uint8).reshape((-1, fld_.itemsize)).T.tobytes()
+
+    if compress == 'zlib':
+        ##level 1 is much faster than the default level, with slightly worse ratio
+        return zlib.compress(buf, level=1)
+    else:
+        raise ValueError('unknown state file compression method: '+compress)
+
+
+class CompressedStateFile(object):
+    """
+    Read access to a state file with compressed records
+
+    The .bin file contains the compressed (byte-shuffled) chunks for each (mem_id, rec_id)
+    followed by an index array [nens, nrec, 2] (int64) with the offset and
+    length of each chunk, the index is located at header['index_offset'].
+    """
+    def __init__(self, binfile, header):
+        self.compress = header['compress']
+        self.dtype = {rec['rec_id']:rec['dtype'] for rec in header['fields']}
+        self.data = np.memmap(binfile, dtype=np.uint8, mode='r')
+        nbytes = header['nens'] * len(self.dtype) * 2 * 8
+        self.index = self.data[header['index_offset']:header['index_offset']+nbytes].view(np.int64).reshape((header['nens'], len(self.dtype), 2))
+
+    def read_record(self, mem_id, rec_id):
+        """Decompress the stored values for record (mem_id, rec_id), as a flat array"""
+        offset, nbytes = self.index[mem_id, rec_id]
+        assert nbytes >= 0, f'record (mem_id={mem_id}, rec_id={rec_id}) is not found in the state file'
+        if self.compress == 'zlib':
+            buf = zlib.decompress(self.data[offset:offset+nbytes])
+        else:
+            raise ValueError('unknown state file compression method: '+self.compress)
+
+        ##undo the byte shuffle in compress_record
+        dtype = type_convert[self.dtype[rec_id]]
+        itemsize = np.dtype(dtype).itemsize
+        return np.frombuffer(buf, dtype=np.uint8).reshape((itemsize, -1)).T.copy().view(dtype).ravel()
+
+
+class StateFileFields(object):
+    """
+    Read-only dict-like access to the locally stored fields[mem_id, rec_id] saved
+    in a state file, each field is read from the file when accessed.
+    Used in place of the field-complete fields to keep them out of memory (c.low_memory)
+    """
+    def __init__(self, c, state_file):
+        self.info = c.state_info
+        self.mask = c.mask
+        self.dtype = c.state_dtype
+        self.inds = c.state_index['inds']
+        self.f = open_state_file(state_file, c.state_info)
+        self.keys_ = {(mem_id, rec_id) for mem_id in c.mem_list[c.pid_mem] for rec_id in c.rec_list[c.pid_rec]}
+
+    def __getitem__(self, key):
+        if key not in self.keys_:
+            raise KeyError(key)
+        mem_id, rec_id = key
+        return read_field(self.f, self.info, self.mask, mem_id, rec_id, self.dtype, self.inds)
+
+    def __contains__(self, key):
+        return key in self.keys_
+
+    def __len__(self):
+        return len(self.keys_)
+
+    def keys(self):
+        return sorted(self.keys_)
+
+
+def write_field(binfile, info, mask, mem_id, rec_id, fld, inds=None):
+    """
+    Write a field to a binary file
+
+    Inputs:
+    - binfile: str or np.memmap
+      File path for the .bin file, or the file already opened by open_state_file()
+
+    - info: state_info dict
+
     - mask: bool, np.array with shape (ny, nx)
       True if the grid point is masked (for example land grid point in ocean models).
       The masked points will not be stored in the binfile to reduce disk usage.
@@ -182,6 +455,10 @@ def write_field(binfile, info, mask, mem_id, rec_id, fld):
 
     - fld: float, np.array
       The field to be written to the file
+
+    - inds: np.array, optional
+      Flat indices of the unmasked points, state_index['inds'] from build_state_index();
+      if not given, they are computed from mask
     """
     ny = info['ny']
     nx = info['nx']
@@ -190,23 +467,23 @@ def write_field(binfile, info, mask, mem_id, rec_id, fld):
     fld_shape = (2, ny, nx) if rec['is_vector'] else (ny, nx)
     assert fld.shape == fld_shape, f'fld shape incorrect: expected {fld_shape}, got {fld.shape}'
 
-    if rec['is_vector']:
-        fld_ = fld[:, ~mask].flatten()
-    else:
-        fld_ = fld[~mask]
+    f = open_state_file(binfile, info, 'r+') if isinstance(binfile, str) else binfile
+    assert not isinstance(f, CompressedStateFile), 'cannot write single records to a compressed state file'
 
-    with open(binfile, 'r+b') as f:
-        f.seek(mem_id*info['size'] + rec['pos'])
-        f.write(struct.pack(fld_.size*type_dic[rec['dtype']], *fld_))
+    if inds is None:
+        inds = np.flatnonzero(~mask)
 
+    fld_ = field_view(f, info, mem_id, rec_id, inds.size)
+    fld_[...] = fld.reshape((-1, ny*nx))[:, inds]
 
-def read_field(binfile, info, mask, mem_id, rec_id):
+
+def read_field(binfile, info, mask, mem_id, rec_id, dtype='double', inds=None):
     """
     Read a field from a binary file
 
     Inputs:
-    - binfile: str
-      File path for the .bin file
+    - binfile: str or np.memmap
+      File path for the .bin file, or the file already opened by open_state_file()
 
     - info: state_info dict
 
@@ -220,6 +497,13 @@ def read_field(binfile, info, mask, mem_id, rec_id):
     - rec_id: int
       Field record index, info['fields'][rec_id] gives the record information
 
+    - dtype: str, optional
+      The dtype ('double' or 'float') of the returned field, default is 'double'
+
+    - inds: np.array, optional
+      Flat indices of the unmasked points, state_index['inds'] from build_state_index();
+      if not given, they are computed from mask
+
     Returns:
     - fld: float, np.array
       The field read from the file
@@ -227,21 +511,21 @@ def read_field(binfile, info, mask, mem_id, rec_id):
     ny = info['ny']
     nx = info['nx']
     rec = info['fields'][rec_id]
-    nv = 2 if rec['is_vector'] else 1
 
     fld_shape = (2, ny, nx) if rec['is_vector'] else (ny, nx)
-    fld_size = np.sum((~mask).astype(int))
 
-    with open(binfile, 'rb') as f:
-        f.seek(mem_id*info['size'] + rec['pos'])
-        fld_ = np.array(struct.unpack((nv*fld_size*type_dic[rec['dtype']]),
-                        f.read(nv*fld_size*type_size[rec['dtype']])))
-        fld = np.full(fld_shape, np.nan)
-        if rec['is_vector']:
-            fld[:, ~mask] = fld_.reshape((2, -1))
-        else:
-            fld[~mask] = fld_
-        return fld
+    f = open_state_file(binfile, info) if isinstance(binfile, str) else binfile
+
+    if inds is None:
+        inds = np.flatnonzero(~mask)
+
+    if isinstance(f, CompressedStateFile):
+        fld_ = f.read_record(mem_id, rec_id).reshape((-1, inds.size))
+    else:
+        fld_ = field_view(f, info, mem_id, rec_id, inds.size)
+    fld = np.full(fld_shape, np.nan, dtype=type_convert[dtype])
+    fld.reshape((-1, ny*nx))[:, inds] = fld_
+    return fld
 
 
 def distribute_state_tasks(c):
@@ -306,7 +590,35 @@ def partition_grid(c):
     return partitions
 
 
-def output_state(c, fields, state_file):
+def build_state_index(c):
+    """
+    Precompute the indices of unmasked grid points, to be reused in the state i/o
+    and transposes instead of applying the mask on the full grid every time
+
+    Inputs:
+    - c: config module, with state_info, mask and partitions
+
+    Returns:
+    - index: dict with
+      'fld_size': int, number of unmasked grid points in a field
+      'inds': np.array[fld_size], flat indices (in a [ny*nx] field) of the unmasked points
+      'par_inds': dict[par_id, np.array], flat indices of the unmasked points
+                  in partition par_id, in the same order as c.mask[jst:jed:dj, ist:ied:di]
+      'par_size': dict[par_id, int], number of unmasked points in partition par_id
+    """
+    inds = np.flatnonzero(~c.mask)
+    index = {'fld_size': inds.size, 'inds': inds, 'par_inds': {}, 'par_size': {}}
+
+    for par_id, (ist,ied,di,jst,jed,dj) in enumerate(c.partitions):
+        jj, ii = np.meshgrid(np.arange(jst,jed,dj), np.arange(ist,ied,di), indexing='ij')
+        msk = c.mask[jst:jed:dj, ist:ied:di]
+        index['par_inds'][par_id] = (jj * c.nx + ii)[~msk]
+        index['par_size'][par_id] = index['par_inds'][par_id].size
+
+    return index
+
+
+def output_state(c, fields, state_file, lossless=False):
     """
     Parallel output the fields to the binary state_file
 
@@ -316,18 +628,41 @@ def output_state(c, fields, state_file):
       the locally stored field-complete fields for output
     - state_file: str
       path to the output binary file
+    - lossless: bool, optional
+      if True, compressed records are not rounded or downcast (see write_fields_compressed),
+      for files read back as inputs
     """
     print = by_rank(c.comm, c.pid_show)(print_with_cache)
     if c.debug:
         print('save state to '+state_file+'\n')
 
+    ##compressed records are written at offsets known only after compression
+    if c.state_file_compress != 'none':
+        write_fields_compressed(c, fields, state_file, c.nens, lossless)
+        if c.debug:
+            print(' done.\n')
+        return
+
     if c.pid == 0:
-        ##if file doesn't exist, create the file
-        open(state_file, 'wb')
-        ##write state_info to the accompanying .dat file
-        write_state_info(state_file, c.state_info)
+        ##create the file with full size for nens members
+        open_state_file(state_file, c.state_info, 'w+', c.nens).flush()
+        ##write state_info to the accompanying .json header
+        write_state_info(state_file, c.state_info, c.mask, c.nens)
     c.comm.Barrier()
 
+    ##collective write with MPI-IO, if not running with mpi, fall back to
+    ##the memory-mapped output below
+    if c.state_file_io == 'mpiio' and mpi_comm(c.comm) is not None:
+        write_fields_mpiio(c, fields, state_file)
+        if c.debug:
+            print(' done.\n')
+        return
+
+    ##all pid write their records with pwrite at the record offsets, the records are not
+    ##page-aligned, so writing through shared memory maps of the file could let neighboring
+    ##pid overwrite each other's partial pages on filesystems without coherent caches across nodes
+    fd = os.open(state_file, os.O_WRONLY)
+
     nm = len(c.mem_list[c.pid_mem])
     nr = len(c.rec_list[c.pid_rec])
 
@@ -337,78 +672,276 @@ def output_state(c, fields, state_file):
                 print(progress_bar(m*nr+r, nm*nr))
 
             ##get the field record for output
-            fld = fields[mem_id, rec_id]
+            fld_ = fields[mem_id, rec_id].reshape((-1, c.ny*c.nx))[:, c.state_index['inds']]
 
             ##write the data to binary file
-            write_field(state_file, c.state_info, c.mask, mem_id, rec_id, fld)
+            pwrite_record(fd, c.state_info, mem_id, rec_id, fld_)
 
+    os.close(fd)
+    c.comm.Barrier()
     if c.debug:
         print(' done.\n')
 
 
-def output_ens_mean(c, fields, mean_file):
+def pwrite_record(fd, info, mem_id, rec_id, fld_):
+    """
+    Write the unmasked values of a field record to an opened state file at its offset
+
+    Inputs:
+    - fd: int, file descriptor from os.open()
+    - info: state_info dict
+    - mem_id: int
+    - rec_id: int
+    - fld_: np.array[nv, fld_size], values at the unmasked points
+    """
+    rec = info['fields'][rec_id]
+    buf = np.ascontiguousarray(fld_, dtype=type_convert[rec['dtype']])
+    os.pwrite(fd, buf.tobytes(), mem_id*info['size'] + rec['pos'])
+
+
+def write_fields_mpiio(c, fields, state_file):
+    """
+    Collective output of the fields to the binary state_file using MPI-IO
+
+    All pid in c.comm call this function together. Each pid sets a file view
+    covering the (mem_id, rec_id) records it owns, the record offsets are given by
+    mem_id*state_info['size'] + state_info['fields'][rec_id]['pos'], and
+    the data are written in one collective call, so that the MPI library
+    can aggregate the small writes instead of every pid doing open/seek/write.
+    To bound the buffer size, the members in mem_list are written in turns.
+
+    Inputs:
+    - c: config module
+    - fields: dict[(mem_id, rec_id), fld]
+      the locally stored field-complete fields for output
+    - state_file: str
+      path to the output binary file, should be already created
+    """
+    from mpi4py import MPI
+
+    print = by_rank(c.comm, c.pid_show)(print_with_cache)
+
+    fh = MPI.File.Open(mpi_comm(c.comm), state_file, MPI.MODE_WRONLY)
+
+    ##all pid go through the same number of collective writes
+    nm_max = np.max([len(lst) for p,lst in c.mem_list.items()])
+
+    for m in range(nm_max):
+        if c.debug:
+            print(progress_bar(m, nm_max))
+
+        ##pack the records for mem_id into a contiguous buffer,
+        ##block lengths and file offsets (in bytes) for the file view
+        blocks, offsets, bufs = [], [], []
+        if m < len(c.mem_list[c.pid_mem]):
+            mem_id = c.mem_list[c.pid_mem][m]
+            for rec_id in sorted(c.rec_list[c.pid_rec], key=lambda i: c.state_info['fields'][i]['pos']):
+                rec = c.state_info['fields'][rec_id]
+                fld_ = fields[mem_id, rec_id].reshape((-1, c.ny*c.nx))[:, c.state_index['inds']]
+                buf = np.ascontiguousarray(fld_, dtype=type_convert[rec['dtype']]).view(np.uint8).ravel()
+                blocks.append(buf.size)
+                offsets.append(mem_id*c.state_info['size'] + rec['pos'])
+                bufs.append(buf)
+        buf = np.concatenate(bufs) if len(bufs)>0 else np.zeros(0, dtype=np.uint8)
+
+        filetype = MPI.BYTE.Create_hindexed(blocks, offsets).Commit()
+        fh.Set_view(0, MPI.BYTE, filetype)
+        fh.Write_all(buf)
+        filetype.Free()
+
+    fh.Close()
+
+
+def write_fields_compressed(c, fields, state_file, nens, lossless=False):
+    """
+    Collective output of the fields to the binary state_file with compressed records
+
+    Each pid compresses its own records, then the chunk sizes are gathered so that
+    every pid knows where to write its chunks, the chunks are stored one after
+    another in (mem_id, rec_id) order, followed by the chunk index. pid 0 writes the
+    .json header with the compression settings and the position of the index.
+    The records are read back transparently by read_field().
+
+    Inputs:
+    - c: config module
+    - fields: dict[(mem_id, rec_id), fld]
+      the locally stored field-complete fields for output
+    - state_file: str
+      path to the output binary file
+    - nens: int
+      number of members in the file
+    - lossless: bool, optional
+      if True, c.state_file_keepbits and c.state_file_downcast are not applied,
+      for files that are read back as inputs (ensemble mean, z coords)
+    """
+    info = c.state_info
+    keepbits = 0 if lossless else c.state_file_keepbits
+
+    ##optionally store 'double' records as 'float' to save space
+    dtype = {rec_id: 'float' if c.state_file_downcast and not lossless else rec['dtype']
+             for rec_id, rec in info['fields'].items()}
+
+    ##compress the locally stored records
+    chunks = {}
+    for (mem_id, rec_id), fld in fields.items():
+        fld_ = fld.reshape((-1, c.ny*c.nx))[:, c.state_index['inds']]
+        chunks[mem_id, rec_id] = compress_record(fld_, dtype[rec_id], c.state_file_compress, keepbits)
+
+    ##collect chunk sizes from all pid and assign their offsets in the file
+    chunk_size = {}
+    for entry in c.comm.allgather({key:len(chk) for key,chk in chunks.items()}):
+        chunk_size.update(entry)
+    index = np.full((nens, len(info['fields']), 2), -1, dtype=np.int64)
+    offset = 0
+    for mem_id, rec_id in sorted(chunk_size.keys()):
+        index[mem_id, rec_id, :] = (offset, chunk_size[mem_id, rec_id])
+        offset += chunk_size[mem_id, rec_id]
+
+    if c.pid == 0:
+        ##create the file, the chunk index is placed after all the chunks
+        with open(state_file, 'wb') as f:
+            f.truncate(offset + index.nbytes)
+            f.seek(offset)
+            f.write(index.tobytes())
+        info_out = {**info, 'fields':{rec_id:{**rec, 'dtype':dtype[rec_id]} for rec_id, rec in info['fields'].items()}}
+        write_state_info(state_file, info_out, c.mask, nens,
+                         compress=c.state_file_compress, keepbits=keepbits,
+                         index_offset=offset)
+    c.comm.Barrier()
+
+    ##write the chunks
+    fd = os.open(state_file, os.O_WRONLY)
+    for key, chk in chunks.items():
+        os.pwrite(fd, chk, int(index[key][0]))
+    os.close(fd)
+    c.comm.Barrier()
+
+
+def output_ens_mean(c, fields, mean_file, spread_file=None):
     """
     Compute ensemble mean of a field stored distributively on all pid_mem
     collect means on pid_mem=0, and output to mean_file
 
+    The sums over members of the unmasked points are reduced with buffer-based
+    Reduce calls in comm_mem, c.ens_mean_batch_size records at a time. If spread_file
+    is given, the mean is allreduced instead, and the sums of squared deviations from
+    the mean are reduced in a second pass to get the ensemble spread (standard deviation),
+    which is written to spread_file. The sums are accumulated in double precision.
+
     Inputs:
     - c: config module
     - fields, dict[(mem_id, rec_id), fld]
       the locally stored field-complete fields for output
     - mean_file: str
       path to the output binary file for the ensemble mean
+    - spread_file: str, optional
+      path to the output binary file for the ensemble spread
     """
 
     print = by_rank(c.comm, c.pid_show)(print_with_cache)
     if c.debug:
         print('compute ensemble mean, save to '+mean_file+'\n')
-    if c.pid == 0:
-        open(mean_file, 'wb')
-        write_state_info(mean_file, c.state_info)
-    c.comm.Barrier()
+    compress = (c.state_file_compress != 'none')
+    out_files = [mean_file] if spread_file is None else [mean_file, spread_file]
+    nmom = len(out_files)  ##number of moments: mean, and spread if needed
 
-    for r, rec_id in enumerate(c.rec_list[c.pid_rec]):
+    if compress:
+        ##mean fields are collected and written together at the end
+        out_fields = [{} for _ in out_files]
+    else:
+        if c.pid == 0:
+            for out_file in out_files:
+                open_state_file(out_file, c.state_info, 'w+', 1).flush()
+                write_state_info(out_file, c.state_info, c.mask, 1)
+        c.comm.Barrier()
+        fd = [os.open(out_file, os.O_WRONLY) for out_file in out_files]
+
+    inds = c.state_index['inds']
+    fld_size = c.state_index['fld_size']
+    rec_list = c.rec_list[c.pid_rec]
+    nbatch = c.ens_mean_batch_size
+
+    for b in range(0, len(rec_list), nbatch):
         if c.debug:
-            print(progress_bar(r, len(c.rec_list[c.pid_rec])))
+            print(progress_bar(b, len(rec_list)))
+        batch = rec_list[b:b+nbatch]
 
-        ##initialize a zero field with right dimensions for rec_id
-        if c.state_info['fields'][rec_id]['is_vector']:
-            sum_fld_pid = np.zeros((2, c.ny, c.nx))
-        else:
-            sum_fld_pid = np.zeros((c.ny, c.nx))
+        ##the records in batch are stacked in the buffer, rec_id occupies rows ofs[i]:ofs[i+1]
+        nv = [2 if c.state_info['fields'][rec_id]['is_vector'] else 1 for rec_id in batch]
+        ofs = np.concatenate([[0], np.cumsum(nv)])
 
         ##sum over all fields locally stored on pid
-        for mem_id in c.mem_list[c.pid_mem]:
-            sum_fld_pid += fields[mem_id, rec_id]
+        sendbuf = np.zeros((ofs[-1], fld_size))
+        for i, rec_id in enumerate(batch):
+            for mem_id in c.mem_list[c.pid_mem]:
+                sendbuf[ofs[i]:ofs[i+1]] += fields[mem_id, rec_id].reshape((-1, c.ny*c.nx))[:, inds]
 
         ##sum over all field sums on different pids together to get the total sum
-        ##TODO:reduce is expensive if only part of pid holds state in memory
-        sum_fld = c.comm_mem.reduce(sum_fld_pid, root=0)
+        ##all pid_mem need the mean for the deviations if spread is needed
+        if nmom > 1:
+            recvbuf = np.empty_like(sendbuf)
+            c.comm_mem.Allreduce(sendbuf, recvbuf)
+        else:
+            recvbuf = np.empty_like(sendbuf) if c.pid_mem == 0 else None
+            c.comm_mem.Reduce(sendbuf, recvbuf, root=0)
+        out = [recvbuf / c.nens] if recvbuf is not None else None
+
+        if nmom > 1:
+            ##second pass: sum of squared deviations from the mean, more accurate than
+            ##the sum of squares for fields with a large offset relative to their spread
+            sendbuf[...] = 0
+            for i, rec_id in enumerate(batch):
+                for mem_id in c.mem_list[c.pid_mem]:
+                    fld_ = fields[mem_id, rec_id].reshape((-1, c.ny*c.nx))[:, inds]
+                    sendbuf[ofs[i]:ofs[i+1]] += (fld_.astype(np.float64) - out[0][ofs[i]:ofs[i+1]])**2
+            recvbuf = np.empty_like(sendbuf) if c.pid_mem == 0 else None
+            c.comm_mem.Reduce(sendbuf, recvbuf, root=0)
+            if c.pid_mem == 0:
+                out.append(np.sqrt(recvbuf / max(c.nens-1, 1)))
 
         if c.pid_mem == 0:
-            mean_fld = sum_fld / c.nens
-            write_field(mean_file, c.state_info, c.mask, 0, rec_id, mean_fld)
-
+            for i, rec_id in enumerate(batch):
+                for n in range(nmom):
+                    if compress:
+                        fld = np.full((nv[i], c.ny, c.nx), np.nan)
+                        fld.reshape((nv[i], -1))[:, inds] = out[n][ofs[i]:ofs[i+1]]
+                        out_fields[n][0, rec_id] = fld if nv[i] == 2 else fld[0]
+                    else:
+                        pwrite_record(fd[n], c.state_info, 0, rec_id, out[n][ofs[i]:ofs[i+1]])
+
+    if compress:
+        ##the mean files are read back by update_restart, inflation and obs operators, keep them lossless
+        for n, out_file in enumerate(out_files):
+            write_fields_compressed(c, out_fields[n], out_file, 1, lossless=True)
+    else:
+        for n in range(nmom):
+            os.close(fd[n])
+        c.comm.Barrier()
     if c.debug:
         print(' done.\n')
 
-    ##clean up
-    # del sum_fld_pid, sum_fld
-
 
 def prepare_state(c):
     """
     Collects fields from model restart files, convert them to the analysis grid,
     preprocess (coarse-graining etc), save to fields[mem_id, rec_id] pointing to the uniq fields
 
+    If c.prepare_state_prefetch > 0, model.read_var for the upcoming records runs
+    in a pool of that many threads, with at most that many reads queued ahead,
+    so that reading the files overlaps with grid conversion of the current record.
+    read_grid, set_destination_grid, convert and z_coords stay on the main thread
+    since they change/use the model.grid attribute.
+
     Inputs:
     - c: config object
 
     Returns:
     - fields: dict[(mem_id, rec_id), fld]
-      where fld is np.array defined on c.grid, it's one of the state variable field
+      where fld is np.array defined on c.grid, it's one of the state variable field,
+      stored with dtype given by c.state_dtype
     - z_coords: dict[(mem_id, rec_id), zfld]
-      where zfld is same shape as fld, it's he z coordinates corresponding to each field
+      where zfld is same shape as fld, it's he z coordinates corresponding to each field,
+      records with the same model_src, mem_id, time and k share the same (read-only) zfld
     """
 
     pid_mem_show = [p for p,lst in c.mem_list.items() if len(lst)>0][0]
@@ -421,43 +954,71 @@ def prepare_state(c):
         print('prepare state by reading fields from model restart\n')
     fields = {}
     z_coords = {}
+    z_bank = {}  ##uniq z fields, indexed by (model_src, mem_id, time, k)
 
     ##process the fields, each proc gets its own workload as a subset of
     ##mem_id,rec_id; all pid goes through their own task list simultaneously
-    nm = len(c.mem_list[c.pid_mem])
-    nr = len(c.rec_list[c.pid_rec])
-
-    for m, mem_id in enumerate(c.mem_list[c.pid_mem]):
-        for r, rec_id in enumerate(c.rec_list[c.pid_rec]):
-            if c.debug:
-                print(progress_bar(m*nr+r, nm*nr))
+    tasks = [(mem_id, rec_id) for mem_id in c.mem_list[c.pid_mem] for rec_id in c.rec_list[c.pid_rec]]
+
+    def read_var(mem_id, rec_id):
+        rec = c.state_info['fields'][rec_id]
+        path = os.path.join(c.work_dir, 'cycle', t2s(rec['time']), rec['model_src'])
+        model = c.model_config[rec['model_src']]
+        return model.read_var(path=path, member=mem_id, **rec)
+
+    ##queue of prefetched reads, (mem_id, rec_id, future)
+    nprefetch = c.prepare_state_prefetch
+    if nprefetch > 0:
+        executor = ThreadPoolExecutor(max_workers=nprefetch)
+        queue = deque()
+        next_task = 0
+
+    for t, (mem_id, rec_id) in enumerate(tasks):
+        if c.debug:
+            print(progress_bar(t, len(tasks)))
 
-            rec = c.state_info['fields'][rec_id]
+        rec = c.state_info['fields'][rec_id]
 
-            ##directory storing model output
-            path = os.path.join(c.work_dir, 'cycle', t2s(rec['time']), rec['model_src'])
+        ##directory storing model output
+        path = os.path.join(c.work_dir, 'cycle', t2s(rec['time']), rec['model_src'])
 
-            ##the model object for handling this variable
-            model = c.model_config[rec['model_src']]
+        ##the model object for handling this variable
+        model = c.model_config[rec['model_src']]
 
-            model.read_grid(path=path, member=mem_id, **rec)
-            model.grid.set_destination_grid(c.grid)
+        model.read_grid(path=path, member=mem_id, **rec)
+        model.grid.set_destination_grid(c.grid)
 
-            ##read field and save to dict
-            var = model.read_var(path=path, member=mem_id, **rec)
-            fld = model.grid.convert(var, is_vector=rec['is_vector'], method='linear', coarse_grain=True)
-            fields[mem_id, rec_id] = fld
+        ##read field and save to dict
+        if nprefetch > 0:
+            ##fill the queue up to nprefetch reads ahead of the current one
+            while next_task < len(tasks) and len(queue) <= nprefetch:
+                queue.append(executor.submit(read_var, *tasks[next_task]))
+                next_task += 1
+            var = queue.popleft().result()
+        else:
+            var = read_var(mem_id, rec_id)
+        fld = model.grid.convert(var, is_vector=rec['is_vector'], method='linear', coarse_grain=True)
+        fields[mem_id, rec_id] = fld.astype(type_convert[c.state_dtype], copy=False)
 
-            ##misc. transform
+        ##misc. transform
 
-            ##read z_coords for the field
-            ##only need to generate the uniq z coords, store in bank
+        ##read z_coords for the field
+        ##only need to generate the uniq z coords, store in bank
+        z_key = (rec['model_src'], mem_id, rec['time'], rec['k'])
+        if z_key not in z_bank:
             zvar = model.z_coords(path=path, member=mem_id, **rec)
             z = model.grid.convert(zvar, is_vector=False, method='linear', coarse_grain=True)
-            if rec['is_vector']:
-                z_coords[mem_id, rec_id] = np.array([z, z])
-            else:
-                z_coords[mem_id, rec_id] = z
+            z_bank[z_key] = z.astype(type_convert[c.state_dtype], copy=False)
+        z = z_bank[z_key]
+        ##records sharing z_key point to the same z array, vector records get a
+        ##read-only view with the u,v components both pointing to z
+        if rec['is_vector']:
+            z_coords[mem_id, rec_id] = np.broadcast_to(z, (2,)+z.shape)
+        else:
+            z_coords[mem_id, rec_id] = z
+
+    if nprefetch > 0:
+        executor.shutdown()
     if c.debug:
         print(' done.\n')
     c.comm.Barrier()
@@ -1,6 +1,9 @@
 import numpy as np
+import os
+from utils.conversion import type_convert, type_size, t2s
 from utils.progress import print_with_cache, progress_bar
-from utils.parallel import by_rank
+from utils.parallel import by_rank, mpi_comm, comm_section
+from .state import read_field
 
 """
 Note: The entire state is distributed across the memory of many processors,
@@ -28,6 +31,13 @@ def transpose_field_to_state(c, fields):
       The locally stored ensemble-complete field chunks on partitions.
     """
 
+    if c.transpose_method == 'alltoallv' and mpi_comm(c.comm_mem) is not None:
+        return transpose_field_to_state_alltoallv(c, fields)
+    if c.transpose_method == 'nonblocking' and mpi_comm(c.comm_mem) is not None:
+        return transpose_field_to_state_nonblocking(c, fields)
+    if c.transpose_method == 'shared' and mpi_comm(c.comm_mem) is not None:
+        return transpose_field_to_state_shared(c, fields)
+
     print = by_rank(c.comm, c.pid_show)(print_with_cache)
     if c.debug:
         print('transpose field-complete to ensemble-complete\n')
@@ -47,7 +57,7 @@ def transpose_field_to_state(c, fields):
             if m < len(c.mem_list[c.pid_mem]):
                 mem_id = c.mem_list[c.pid_mem][m]
                 rec = c.state_info['fields'][rec_id]
-                fld = fields[mem_id, rec_id].copy()
+                fld = fields[mem_id, rec_id]
 
             ## - for each source pid_mem (src_pid) with fields[mem_id, rec_id],
             ##   send chunk of fld[..., jstart:jend:dj, istart:iend:di] to
@@ -69,14 +79,12 @@ def transpose_field_to_state(c, fields):
                 for dst_pid in np.mod(np.arange(c.nproc_mem)+c.pid_mem, c.nproc_mem):
                     fld_chk = {}
                     for par_id in c.par_list[dst_pid]:
-                        ##slice for this par_id
-                        istart,iend,di,jstart,jend,dj = c.partitions[par_id]
-                        ##save the unmasked points in slice to fld_chk for this par_id
-                        mask_chk = c.mask[jstart:jend:dj, istart:iend:di]
+                        ##save the unmasked points in partition to fld_chk for this par_id
+                        inds = c.state_index['par_inds'][par_id]
                         if rec['is_vector']:
-                            fld_chk[par_id] = fld[:, jstart:jend:dj, istart:iend:di][:, ~mask_chk]
+                            fld_chk[par_id] = fld.reshape((2, -1))[:, inds]
                         else:
-                            fld_chk[par_id] = fld[jstart:jend:dj, istart:iend:di][~mask_chk]
+                            fld_chk[par_id] = fld.reshape(-1)[inds]
 
                     if dst_pid == c.pid_mem:
                         ##same pid, so just write to state
@@ -110,6 +118,13 @@ def transpose_state_to_field(c, state):
       the locally stored field-complete fields for subset of mem_id,rec_id.
     """
 
+    if c.transpose_method == 'alltoallv' and mpi_comm(c.comm_mem) is not None:
+        return transpose_state_to_field_alltoallv(c, state)
+    if c.transpose_method == 'nonblocking' and mpi_comm(c.comm_mem) is not None:
+        return transpose_state_to_field_nonblocking(c, state)
+    if c.transpose_method == 'shared' and mpi_comm(c.comm_mem) is not None:
+        return transpose_state_to_field_shared(c, state)
+
     print = by_rank(c.comm, c.pid_show)(print_with_cache)
     if c.debug:
         print('transpose ensemble-complete to field-complete\n')
@@ -131,9 +146,9 @@ def transpose_state_to_field(c, state):
                 mem_id = c.mem_list[c.pid_mem][m]
                 rec = c.state_info['fields'][rec_id]
                 if rec['is_vector']:
-                    fld = np.full((2, c.ny, c.nx), np.nan)
+                    fld = np.full((2, c.ny, c.nx), np.nan, dtype=type_convert[c.state_dtype])
                 else:
-                    fld = np.full((c.ny, c.nx), np.nan)
+                    fld = np.full((c.ny, c.nx), np.nan, dtype=type_convert[c.state_dtype])
 
             ##this is just the reverse of transpose_field_to_state
             ## we take the exact steps, but swap send and recv operations here
@@ -151,17 +166,16 @@ def transpose_state_to_field(c, state):
             if m < len(c.mem_list[c.pid_mem]):
                 for src_pid in np.mod(np.arange(c.nproc_mem)+c.pid_mem, c.nproc_mem):
                     if src_pid == c.pid_mem:
-                        ##same pid, so just copy fld_chk from state
-                        fld_chk = state[mem_id, rec_id].copy()
+                        ##same pid, so just take fld_chk from state
+                        fld_chk = state[mem_id, rec_id]
                     else:
                         ##receive fld_chk from src_pid's state
                         fld_chk = c.comm_mem.recv(source=src_pid, tag=m)
 
                     ##unpack the fld_chk to form a complete field
                     for par_id in c.par_list[src_pid]:
-                        istart,iend,di,jstart,jend,dj = c.partitions[par_id]
-                        mask_chk = c.mask[jstart:jend:dj, istart:iend:di]
-                        fld[..., jstart:jend:dj, istart:iend:di][..., ~mask_chk] = fld_chk[par_id]
+                        inds = c.state_index['par_inds'][par_id]
+                        fld.reshape((-1, c.ny*c.nx))[:, inds] = fld_chk[par_id]
 
                     fields[mem_id, rec_id] = fld
 
@@ -177,6 +191,612 @@ def transpose_state_to_field(c, state):
     return fields
 
 
+def transpose_traffic(c):
+    """
+    Estimate the number of bytes sent between ranks on the same node (intra) and
+    across nodes (inter) in transpose_field_to_state for the whole state, given
+    mem_list, par_list and the node of each pid_mem in c.pid_mem_node
+
+    Returns:
+    - intra, inter: int
+    """
+    ##bytes per grid point for all records in the state
+    nv = np.sum([2 if rec['is_vector'] else 1 for rec in c.state_info['fields'].values()])
+    bpp = nv * type_size[c.state_dtype]
+    npts = {p: np.sum([c.state_index['par_size'][par_id] for par_id in c.par_list[p]], dtype=int)
+            for p in range(c.nproc_mem)}
+    intra, inter = 0, 0
+    for src_pid in range(c.nproc_mem):
+        for dst_pid in range(c.nproc_mem):
+            if src_pid == dst_pid:
+                continue
+            nbytes = len(c.mem_list[src_pid]) * bpp * npts[dst_pid]
+            if c.pid_mem_node[src_pid] == c.pid_mem_node[dst_pid]:
+                intra += nbytes
+            else:
+                inter += nbytes
+    return intra, inter
+
+
+def report_transpose_traffic(c):
+    """Show the estimated intra/inter-node volume of the state transpose"""
+    print = by_rank(c.comm, c.pid_show)(print_with_cache)
+    intra, inter = transpose_traffic(c)
+    nnode = len(set(c.pid_mem_node.values()))
+    print(f'state transpose on {nnode} node(s): intra-node {intra/2**20:.1f} MB, inter-node {inter/2**20:.1f} MB\n')
+
+
+def partition_inds(c, pid):
+    """
+    Flat indices of the unmasked points in all the partitions stored on pid (pid_mem)
+
+    Inputs:
+    - c: config module
+    - pid: int, rank in comm_mem
+
+    Returns:
+    - inds: np.array, state_index['par_inds'] concatenated over par_id in c.par_list[pid]
+    - ofs: dict[par_id, int], start position of par_id in inds
+    """
+    inds = [c.state_index['par_inds'][par_id] for par_id in c.par_list[pid]]
+    ofs = np.cumsum([0] + [len(i) for i in inds])
+    ofs = {par_id: ofs[i] for i, par_id in enumerate(c.par_list[pid])}
+    if len(inds) == 0:
+        return np.array([], dtype=int), ofs
+    return np.concatenate(inds), ofs
+
+
+def alltoallv_layout(c, batch, mem_list, npts):
+    """
+    Counts and displacements for the Alltoallv of a batch of records
+
+    The buffer for each pid holds a block for every (mem_id, rec_id) pair,
+    mem_id in mem_list[pid] and rec_id in batch, each block has shape [nv, npts[pid]]
+
+    Inputs:
+    - c: config module
+    - batch: list of rec_id
+    - mem_list: dict[pid, list of mem_id]
+    - npts: dict[pid, int], number of points in the block for each pid
+
+    Returns:
+    - counts, displs: np.array[nproc_mem], number of elements and start position for each pid
+    - rec_ofs: np.array, start position of rec_id blocks (for one member) in units of npts
+    """
+    nv = [2 if c.state_info['fields'][rec_id]['is_vector'] else 1 for rec_id in batch]
+    rec_ofs = np.cumsum([0] + nv)
+    counts = np.array([len(mem_list[p]) * rec_ofs[-1] * npts[p] for p in range(c.nproc_mem)])
+    displs = np.cumsum(np.concatenate([[0], counts[:-1]]))
+    return counts, displs, rec_ofs
+
+
+def transpose_field_to_state_alltoallv(c, fields):
+    """
+    Same as transpose_field_to_state, but the chunks for all partitions stored on a
+    destination pid are packed in one contiguous buffer, and exchanged with a single
+    Alltoallv in comm_mem for each batch of c.transpose_batch_size records.
+    The state chunks are views into the receive buffer.
+    """
+    print = by_rank(c.comm, c.pid_show)(print_with_cache)
+    if c.debug:
+        print('transpose field-complete to ensemble-complete (alltoallv)\n')
+    comm = c.comm_mem
+    dtype = type_convert[c.state_dtype]
+    state = {}
+
+    pinds = {}
+    for p in range(c.nproc_mem):
+        pinds[p], _ = partition_inds(c, p)
+    npts = {p: len(pinds[p]) for p in range(c.nproc_mem)}
+    _, par_ofs = partition_inds(c, c.pid_mem)
+
+    ##send to each pid the blocks for my members, receive from each pid the blocks for its members
+    my_mems = {p: c.mem_list[c.pid_mem] for p in range(c.nproc_mem)}
+    my_npts = {p: npts[c.pid_mem] for p in range(c.nproc_mem)}
+
+    rec_list = c.rec_list[c.pid_rec]
+    nbatch = c.transpose_batch_size
+    for b in range(0, len(rec_list), nbatch):
+        if c.debug:
+            print(progress_bar(b, len(rec_list)))
+        batch = rec_list[b:b+nbatch]
+        sendcounts, sdispls, rec_ofs = alltoallv_layout(c, batch, my_mems, npts)
+        recvcounts, rdispls, _ = alltoallv_layout(c, batch, c.mem_list, my_npts)
+
+        ##pack the unmasked points in partitions of dst_pid into the send buffer
+        sendbuf = np.empty(np.sum(sendcounts), dtype=dtype)
+        for dst_pid in range(c.nproc_mem):
+            n = npts[dst_pid]
+            for m, mem_id in enumerate(c.mem_list[c.pid_mem]):
+                for r, rec_id in enumerate(batch):
+                    nv = rec_ofs[r+1] - rec_ofs[r]
+                    ofs = sdispls[dst_pid] + (m*rec_ofs[-1] + rec_ofs[r]) * n
+                    blk = sendbuf[ofs:ofs+nv*n].reshape((nv, n))
+                    blk[...] = fields[mem_id, rec_id].reshape((nv, -1))[:, pinds[dst_pid]]
+
+        recvbuf = np.empty(np.sum(recvcounts), dtype=dtype)
+        comm.Alltoallv([sendbuf, (sendcounts, sdispls)], [recvbuf, (recvcounts, rdispls)])
+        del sendbuf
+
+        ##unpack: state chunks are views of the blocks from src_pid
+        n = npts[c.pid_mem]
+        for src_pid in range(c.nproc_mem):
+            for m, mem_id in enumerate(c.mem_list[src_pid]):
+                for r, rec_id in enumerate(batch):
+                    rec = c.state_info['fields'][rec_id]
+                    nv = rec_ofs[r+1] - rec_ofs[r]
+                    ofs = rdispls[src_pid] + (m*rec_ofs[-1] + rec_ofs[r]) * n
+                    blk = recvbuf[ofs:ofs+nv*n].reshape((nv, n))
+                    state[mem_id, rec_id] = {}
+                    for par_id in c.par_list[c.pid_mem]:
+                        ps = c.state_index['par_size'][par_id]
+                        if rec['is_vector']:
+                            state[mem_id, rec_id][par_id] = blk[:, par_ofs[par_id]:par_ofs[par_id]+ps]
+                        else:
+                            state[mem_id, rec_id][par_id] = blk[0, par_ofs[par_id]:par_ofs[par_id]+ps]
+    if c.debug:
+        print(' done.\n')
+
+    return state
+
+
+def transpose_state_to_field_alltoallv(c, state):
+    """
+    Same as transpose_state_to_field, the reverse of transpose_field_to_state_alltoallv
+    """
+    print = by_rank(c.comm, c.pid_show)(print_with_cache)
+    if c.debug:
+        print('transpose ensemble-complete to field-complete (alltoallv)\n')
+    comm = c.comm_mem
+    dtype = type_convert[c.state_dtype]
+    fields = {}
+
+    pinds = {}
+    for p in range(c.nproc_mem):
+        pinds[p], _ = partition_inds(c, p)
+    npts = {p: len(pinds[p]) for p in range(c.nproc_mem)}
+    _, par_ofs = partition_inds(c, c.pid_mem)
+
+    my_mems = {p: c.mem_list[c.pid_mem] for p in range(c.nproc_mem)}
+    my_npts = {p: npts[c.pid_mem] for p in range(c.nproc_mem)}
+
+    rec_list = c.rec_list[c.pid_rec]
+    nbatch = c.transpose_batch_size
+    for b in range(0, len(rec_list), nbatch):
+        if c.debug:
+            print(progress_bar(b, len(rec_list)))
+        batch = rec_list[b:b+nbatch]
+        sendcounts, sdispls, rec_ofs = alltoallv_layout(c, batch, c.mem_list, my_npts)
+        recvcounts, rdispls, _ = alltoallv_layout(c, batch, my_mems, npts)
+
+        ##pack my partitions of the fields for members on dst_pid
+        n = npts[c.pid_mem]
+        sendbuf = np.empty(np.sum(sendcounts), dtype=dtype)
+        for dst_pid in range(c.nproc_mem):
+            for m, mem_id in enumerate(c.mem_list[dst_pid]):
+                for r, rec_id in enumerate(batch):
+                    nv = rec_ofs[r+1] - rec_ofs[r]
+                    ofs = sdispls[dst_pid] + (m*rec_ofs[-1] + rec_ofs[r]) * n
+                    blk = sendbuf[ofs:ofs+nv*n].reshape((nv, n))
+                    for par_id in c.par_list[c.pid_mem]:
+                        ps = c.state_index['par_size'][par_id]
+                        blk[:, par_ofs[par_id]:par_ofs[par_id]+ps] = state[mem_id, rec_id][par_id]
+                    del state[mem_id, rec_id]   ##free up memory
+
+        recvbuf = np.empty(np.sum(recvcounts), dtype=dtype)
+        comm.Alltoallv([sendbuf, (sendcounts, sdispls)], [recvbuf, (recvcounts, rdispls)])
+        del sendbuf
+
+        ##unpack the blocks from src_pid to form complete fields
+        for m, mem_id in enumerate(c.mem_list[c.pid_mem]):
+            for r, rec_id in enumerate(batch):
+                nv = rec_ofs[r+1] - rec_ofs[r]
+                fld = np.full((nv, c.ny, c.nx), np.nan, dtype=dtype)
+                for src_pid in range(c.nproc_mem):
+                    n = npts[src_pid]
+                    ofs = rdispls[src_pid] + (m*rec_ofs[-1] + rec_ofs[r]) * n
+                    fld.reshape((nv, -1))[:, pinds[src_pid]] = recvbuf[ofs:ofs+nv*n].reshape((nv, n))
+                fields[mem_id, rec_id] = fld if nv == 2 else fld[0]
+    if c.debug:
+        print(' done.\n')
+
+    return fields
+
+
+def nonblocking_comm(c):
+    """
+    A duplicate of comm_mem for the nonblocking transposes, so that their messages
+    (tagged by par_id) are not mixed up with the other send/recv in comm_mem
+    """
+    if not hasattr(c, 'comm_mem_nb'):
+        c.comm_mem_nb = c.comm_mem.Dup()
+        c.pending_recvs = {}  ##dict[par_id, list of requests]
+        c.pending_sends = []
+    return c.comm_mem_nb
+
+
+def wait_partition(c, par_id):
+    """
+    Wait for the pending receives of partition par_id from the nonblocking
+    transpose_field_to_state, does nothing if there are no pending requests
+    """
+    if hasattr(c, 'pending_recvs'):
+        for req in c.pending_recvs.pop(par_id, []):
+            req.Wait()
+
+
+def wait_all(c):
+    """Wait for all pending receives and sends from the nonblocking transposes"""
+    if hasattr(c, 'pending_recvs'):
+        for par_id in list(c.pending_recvs.keys()):
+            wait_partition(c, par_id)
+        for req in c.pending_sends:
+            req.Wait()
+        c.pending_sends = []
+
+
+def transpose_field_to_state_nonblocking(c, fields):
+    """
+    Same as transpose_field_to_state, but with nonblocking communication.
+    All the receives are posted first, then the chunks are sliced and sent with Isend
+    one partition at a time: for each (src_pid, par_id), all the mem_id,rec_id chunks
+    are packed in one buffer with shape [nmem, nv, par_size], nmem is the number of
+    members on src_pid, nv stacks the records (2 rows for vector fields).
+
+    The function returns without waiting for the messages, state[mem_id, rec_id][par_id]
+    are views into the receive buffers. Call wait_partition(c, par_id) before using
+    the chunks of par_id, and wait_all(c) to finish all the communication.
+    """
+    print = by_rank(c.comm, c.pid_show)(print_with_cache)
+    if c.debug:
+        print('transpose field-complete to ensemble-complete (nonblocking)\n')
+    comm = nonblocking_comm(c)
+    dtype = type_convert[c.state_dtype]
+
+    ##position of the records in the stacked buffer
+    rec_list = c.rec_list[c.pid_rec]
+    nv = {rec_id: 2 if c.state_info['fields'][rec_id]['is_vector'] else 1 for rec_id in rec_list}
+    rec_ofs = dict(zip(rec_list, np.cumsum([0] + [nv[r] for r in rec_list])))
+    nv_tot = np.sum([nv[r] for r in rec_list], dtype=int)
+
+    def chunk(buf, m, rec_id):
+        chk = buf[m, rec_ofs[rec_id]:rec_ofs[rec_id]+nv[rec_id]]
+        return chk if nv[rec_id] == 2 else chk[0]
+
+    state = {(mem_id, rec_id): {} for p in range(c.nproc_mem) for mem_id in c.mem_list[p] for rec_id in rec_list}
+
+    ##1) post the receives for all my partitions from other src_pid
+    for src_pid in range(c.nproc_mem):
+        nm = len(c.mem_list[src_pid])
+        if src_pid == c.pid_mem or nm == 0:
+            continue
+        for par_id in c.par_list[c.pid_mem]:
+            buf = np.empty((nm, nv_tot, c.state_index['par_size'][par_id]), dtype=dtype)
+            c.pending_recvs.setdefault(par_id, []).append(comm.Irecv(buf, source=src_pid, tag=par_id))
+            for m, mem_id in enumerate(c.mem_list[src_pid]):
+                for rec_id in rec_list:
+                    state[mem_id, rec_id][par_id] = chunk(buf, m, rec_id)
+
+    ##2) slice my fields for each partition and send them to its dst_pid, start from pid
+    ##   itself so that the local chunks are ready first
+    nm = len(c.mem_list[c.pid_mem])
+    if nm > 0:
+        for dst_pid in np.mod(np.arange(c.nproc_mem)+c.pid_mem, c.nproc_mem):
+            for par_id in c.par_list[dst_pid]:
+                inds = c.state_index['par_inds'][par_id]
+                buf = np.empty((nm, nv_tot, inds.size), dtype=dtype)
+                for m, mem_id in enumerate(c.mem_list[c.pid_mem]):
+                    for rec_id in rec_list:
+                        fld = fields[mem_id, rec_id].reshape((nv[rec_id], -1))
+                        buf[m, rec_ofs[rec_id]:rec_ofs[rec_id]+nv[rec_id]] = fld[:, inds]
+                if dst_pid == c.pid_mem:
+                    for m, mem_id in enumerate(c.mem_list[c.pid_mem]):
+                        for rec_id in rec_list:
+                            state[mem_id, rec_id][par_id] = chunk(buf, m, rec_id)
+                else:
+                    c.pending_sends.append(comm.Isend(buf, dest=dst_pid, tag=par_id))
+    if c.debug:
+        print(' done.\n')
+
+    return state
+
+
+def transpose_state_to_field_nonblocking(c, state):
+    """
+    Same as transpose_state_to_field, the reverse of transpose_field_to_state_nonblocking,
+    the chunks received from each (src_pid, par_id) are unpacked as soon as they arrive.
+    """
+    from mpi4py import MPI
+    print = by_rank(c.comm, c.pid_show)(print_with_cache)
+    if c.debug:
+        print('transpose ensemble-complete to field-complete (nonblocking)\n')
+    comm = nonblocking_comm(c)
+    dtype = type_convert[c.state_dtype]
+    wait_all(c)
+
+    rec_list = c.rec_list[c.pid_rec]
+    nv = {rec_id: 2 if c.state_info['fields'][rec_id]['is_vector'] else 1 for rec_id in rec_list}
+    rec_ofs = dict(zip(rec_list, np.cumsum([0] + [nv[r] for r in rec_list])))
+    nv_tot = np.sum([nv[r] for r in rec_list], dtype=int)
+
+    fields = {}
+    nm = len(c.mem_list[c.pid_mem])
+    for mem_id in c.mem_list[c.pid_mem]:
+        for rec_id in rec_list:
+            fields[mem_id, rec_id] = np.full((nv[rec_id], c.ny, c.nx), np.nan, dtype=dtype)
+
+    def unpack(buf, par_id):
+        inds = c.state_index['par_inds'][par_id]
+        for m, mem_id in enumerate(c.mem_list[c.pid_mem]):
+            for rec_id in rec_list:
+                fld = fields[mem_id, rec_id].reshape((nv[rec_id], -1))
+                fld[:, inds] = buf[m, rec_ofs[rec_id]:rec_ofs[rec_id]+nv[rec_id]]
+
+    ##1) post the receives for my members from other src_pid
+    recvs, recv_bufs = [], []
+    if nm > 0:
+        for src_pid in range(c.nproc_mem):
+            if src_pid == c.pid_mem:
+                continue
+            for par_id in c.par_list[src_pid]:
+                buf = np.empty((nm, nv_tot, c.state_index['par_size'][par_id]), dtype=dtype)
+                recvs.append(comm.Irecv(buf, source=src_pid, tag=par_id))
+                recv_bufs.append((buf, par_id))
+
+    ##2) pack my partitions for the members on dst_pid and send
+    sends = []
+    for dst_pid in np.mod(np.arange(c.nproc_mem)+c.pid_mem, c.nproc_mem):
+        nm_dst = len(c.mem_list[dst_pid])
+        if nm_dst == 0:
+            continue
+        for par_id in c.par_list[c.pid_mem]:
+            buf = np.empty((nm_dst, nv_tot, c.state_index['par_size'][par_id]), dtype=dtype)
+            for m, mem_id in enumerate(c.mem_list[dst_pid]):
+                for rec_id in rec_list:
+                    buf[m, rec_ofs[rec_id]:rec_ofs[rec_id]+nv[rec_id]] = state[mem_id, rec_id][par_id]
+            if dst_pid == c.pid_mem:
+                unpack(buf, par_id)
+            else:
+                sends.append(comm.Isend(buf, dest=dst_pid, tag=par_id))
+        for mem_id in c.mem_list[dst_pid]:
+            for rec_id in rec_list:
+                del state[mem_id, rec_id]   ##free up memory
+
+    ##3) unpack the chunks as they arrive
+    for _ in range(len(recvs)):
+        i = MPI.Request.Waitany(recvs)
+        unpack(*recv_bufs[i])
+    MPI.Request.Waitall(sends)
+
+    for key, fld in fields.items():
+        if nv[key[1]] == 1:
+            fields[key] = fld[0]
+    if c.debug:
+        print(' done.\n')
+
+    return fields
+
+
+def pack_lobs(c, seq, obs_rec_id, par_list):
+    """
+    Subset of an obs (prior) sequence for the partitions in par_list
+
+    The obs within hroi of neighbouring partitions overlap, so the union of their
+    obs_inds is stored only once, along with the positions of each par_id in the union
+
+    Inputs:
+    - c: config object
+    - seq: np.array (obs prior seq) or dict[key, np.array] (obs seq)
+    - obs_rec_id: int
+    - par_list: list of par_id
+
+    Returns:
+    - lobs_pack: dict with 'data': seq subset to the union of obs_inds, and
+      'local': dict[par_id, np.array], indices in the union for each par_id
+    """
+    inds = [c.obs_inds[obs_rec_id][par_id] for par_id in par_list]
+    union, local = np.unique(np.concatenate([np.array([], dtype=int)] + inds), return_inverse=True)
+    pos = np.cumsum([0] + [len(i) for i in inds])
+    lobs_pack = {'local': {par_id: local[pos[i]:pos[i+1]] for i, par_id in enumerate(par_list)}}
+    if isinstance(seq, dict):
+        lobs_pack['data'] = {key: seq[key][..., union] for key in ('obs', 'err_std', 'x', 'y', 'z', 't')}
+    else:
+        lobs_pack['data'] = seq[..., union]
+    return lobs_pack
+
+
+def unpack_lobs(lobs_pack):
+    """
+    Reverse of pack_lobs, returns the lobs_seq dict[par_id, np.array or dict[key, np.array]]
+    """
+    data = lobs_pack['data']
+    if isinstance(data, dict):
+        return {par_id: {key: data[key][..., local] for key in data.keys()}
+                for par_id, local in lobs_pack['local'].items()}
+    return {par_id: data[..., local] for par_id, local in lobs_pack['local'].items()}
+
+
+def shared_node(c):
+    """
+    Shared-memory communicator for ranks of comm_mem on the same compute node
+
+    Returns:
+    - comm_node: mpi communicator from Split_type(COMM_TYPE_SHARED) of comm_mem
+    - on_node: dict[pid_mem, int], rank in comm_node for the pid_mem on my node
+    """
+    from mpi4py import MPI
+    if not hasattr(c, 'comm_node'):
+        c.comm_node = mpi_comm(c.comm_mem).Split_type(MPI.COMM_TYPE_SHARED)
+        c.shared_wins = {}  ##dict[id(state), window holding the state]
+    on_node = {p: r for r, p in enumerate(c.comm_node.allgather(c.pid_mem))}
+    return c.comm_node, on_node
+
+
+def shared_layout(c):
+    """
+    Layout of the ensemble-complete state in the shared window: the segment of each pid_mem
+    is an array [nens, nv, npts], nv stacks the records in rec_list (2 rows for vector fields),
+    npts is the number of points in all partitions of pid_mem, as in partition_inds()
+    """
+    rec_list = c.rec_list[c.pid_rec]
+    nv = {rec_id: 2 if c.state_info['fields'][rec_id]['is_vector'] else 1 for rec_id in rec_list}
+    rec_ofs = dict(zip(rec_list, np.cumsum([0] + [nv[r] for r in rec_list])))
+    nv_tot = np.sum([nv[r] for r in rec_list], dtype=int)
+    pinds = {}
+    for p in range(c.nproc_mem):
+        pinds[p], _ = partition_inds(c, p)
+        ##receiving directly into the window needs the members of each pid in one block
+        assert np.all(np.diff(c.mem_list[p]) == 1), 'shared transpose requires contiguous mem_list'
+    _, par_ofs = partition_inds(c, c.pid_mem)
+    return nv, rec_ofs, nv_tot, pinds, par_ofs
+
+
+def shared_state_segments(c, win, on_node, nv_tot, pinds):
+    """numpy arrays pointing to the window segments of the pid_mem on my node"""
+    dtype = type_convert[c.state_dtype]
+    seg = {}
+    for p, r in on_node.items():
+        buf, _ = win.Shared_query(r)
+        seg[p] = np.ndarray(buffer=buf, dtype=dtype, shape=(c.nens, nv_tot, len(pinds[p])))
+    return seg
+
+
+def transpose_field_to_state_shared(c, fields):
+    """
+    Same as transpose_field_to_state, but the ensemble-complete state is allocated in an
+    MPI shared-memory window (Win.Allocate_shared) for each compute node. Ranks on the same
+    node write their chunks directly into the segment of the destination pid, only the
+    chunks for pid on other nodes are exchanged (Alltoallv), received straight into the window.
+
+    The state chunks are views into the window, it is freed after transpose_state_to_field.
+    """
+    from mpi4py import MPI
+    print = by_rank(c.comm, c.pid_show)(print_with_cache)
+    if c.debug:
+        print('transpose field-complete to ensemble-complete (shared memory)\n')
+    comm = c.comm_mem
+    comm_node, on_node = shared_node(c)
+    dtype = type_convert[c.state_dtype]
+    nv, rec_ofs, nv_tot, pinds, par_ofs = shared_layout(c)
+    npts = {p: len(pinds[p]) for p in range(c.nproc_mem)}
+    my_mems = c.mem_list[c.pid_mem]
+    nm = len(my_mems)
+
+    win = MPI.Win.Allocate_shared(c.nens*nv_tot*npts[c.pid_mem]*dtype().itemsize, dtype().itemsize, comm=comm_node)
+    seg = shared_state_segments(c, win, on_node, nv_tot, pinds)
+    win.Fence()
+
+    ##slice my fields for each dst_pid, on-node dst_pid get the chunks in their segment,
+    ##the chunks for off-node dst_pid are packed into sendbuf
+    sendcounts = np.array([0 if p in on_node else nm*nv_tot*npts[p] for p in range(c.nproc_mem)])
+    sdispls = np.cumsum(np.concatenate([[0], sendcounts[:-1]]))
+    sendbuf = np.empty(np.sum(sendcounts), dtype=dtype)
+    for dst_pid in range(c.nproc_mem):
+        if dst_pid in on_node:
+            blk = seg[dst_pid][my_mems[0]:my_mems[0]+nm] if nm > 0 else None
+        else:
+            blk = sendbuf[sdispls[dst_pid]:sdispls[dst_pid]+sendcounts[dst_pid]].reshape((nm, nv_tot, npts[dst_pid]))
+        for m, mem_id in enumerate(my_mems):
+            for rec_id in c.rec_list[c.pid_rec]:
+                fld = fields[mem_id, rec_id].reshape((nv[rec_id], -1))
+                blk[m, rec_ofs[rec_id]:rec_ofs[rec_id]+nv[rec_id]] = fld[:, pinds[dst_pid]]
+
+    ##receive the off-node members into my segment
+    n = nv_tot * npts[c.pid_mem]
+    recvcounts = np.array([0 if p in on_node else len(c.mem_list[p])*n for p in range(c.nproc_mem)])
+    rdispls = np.array([c.mem_list[p][0]*n if len(c.mem_list[p]) > 0 else 0 for p in range(c.nproc_mem)])
+    comm.Alltoallv([sendbuf, (sendcounts, sdispls)], [seg[c.pid_mem].reshape(-1), (recvcounts, rdispls)])
+    del sendbuf
+    win.Fence()
+
+    state = {}
+    for mem_id in range(c.nens):
+        for rec_id in c.rec_list[c.pid_rec]:
+            state[mem_id, rec_id] = {}
+            for par_id in c.par_list[c.pid_mem]:
+                chk = seg[c.pid_mem][mem_id, rec_ofs[rec_id]:rec_ofs[rec_id]+nv[rec_id],
+                                     par_ofs[par_id]:par_ofs[par_id]+c.state_index['par_size'][par_id]]
+                state[mem_id, rec_id][par_id] = chk if nv[rec_id] == 2 else chk[0]
+    c.shared_wins[id(state)] = win
+    if c.debug:
+        print(' done.\n')
+
+    return state
+
+
+def transpose_state_to_field_shared(c, state):
+    """
+    Same as transpose_state_to_field, the reverse of transpose_field_to_state_shared,
+    ranks read the chunks of on-node pid directly from their window segments.
+    If state is not in a shared window (e.g. loaded from a checkpoint), it is copied into one.
+    All the shared windows are freed at the end.
+    """
+    from mpi4py import MPI
+    print = by_rank(c.comm, c.pid_show)(print_with_cache)
+    if c.debug:
+        print('transpose ensemble-complete to field-complete (shared memory)\n')
+    comm = c.comm_mem
+    comm_node, on_node = shared_node(c)
+    dtype = type_convert[c.state_dtype]
+    nv, rec_ofs, nv_tot, pinds, par_ofs = shared_layout(c)
+    npts = {p: len(pinds[p]) for p in range(c.nproc_mem)}
+    my_mems = c.mem_list[c.pid_mem]
+    nm = len(my_mems)
+
+    win = c.shared_wins.get(id(state))
+    if comm_node.allreduce(win is None, op=MPI.LOR):
+        ##copy the state into a new window; the existing windows were allocated by all the
+        ##on-node ranks together, they are freed (in the same order on every rank) after the
+        ##copy, since the state chunks may be views into them
+        old_wins = list(c.shared_wins.values())
+        c.shared_wins.clear()
+        win = MPI.Win.Allocate_shared(c.nens*nv_tot*npts[c.pid_mem]*dtype().itemsize, dtype().itemsize, comm=comm_node)
+        c.shared_wins[id(state)] = win
+        seg = shared_state_segments(c, win, on_node, nv_tot, pinds)
+        for (mem_id, rec_id), chks in state.items():
+            for par_id, chk in chks.items():
+                seg[c.pid_mem][mem_id, rec_ofs[rec_id]:rec_ofs[rec_id]+nv[rec_id],
+                               par_ofs[par_id]:par_ofs[par_id]+c.state_index['par_size'][par_id]] = chk
+        comm_node.Barrier()
+        for old_win in old_wins:
+            old_win.Free()
+    seg = shared_state_segments(c, win, on_node, nv_tot, pinds)
+    win.Fence()
+
+    ##send my segment blocks to off-node dst_pid for their members
+    n = nv_tot * npts[c.pid_mem]
+    sendcounts = np.array([0 if p in on_node else len(c.mem_list[p])*n for p in range(c.nproc_mem)])
+    sdispls = np.array([c.mem_list[p][0]*n if len(c.mem_list[p]) > 0 else 0 for p in range(c.nproc_mem)])
+    recvcounts = np.array([0 if p in on_node else nm*nv_tot*npts[p] for p in range(c.nproc_mem)])
+    rdispls = np.cumsum(np.concatenate([[0], recvcounts[:-1]]))
+    recvbuf = np.empty(np.sum(recvcounts), dtype=dtype)
+    comm.Alltoallv([seg[c.pid_mem].reshape(-1), (sendcounts, sdispls)], [recvbuf, (recvcounts, rdispls)])
+
+    ##assemble my fields from the on-node segments and the received blocks
+    fields = {}
+    for m, mem_id in enumerate(my_mems):
+        for rec_id in c.rec_list[c.pid_rec]:
+            fld = np.full((nv[rec_id], c.ny, c.nx), np.nan, dtype=dtype)
+            for src_pid in range(c.nproc_mem):
+                if src_pid in on_node:
+                    blk = seg[src_pid][mem_id]
+                else:
+                    blk = recvbuf[rdispls[src_pid]:rdispls[src_pid]+recvcounts[src_pid]].reshape((nm, nv_tot, npts[src_pid]))[m]
+                fld.reshape((nv[rec_id], -1))[:, pinds[src_pid]] = blk[rec_ofs[rec_id]:rec_ofs[rec_id]+nv[rec_id]]
+            fields[mem_id, rec_id] = fld if nv[rec_id] == 2 else fld[0]
+    win.Fence()
+
+    ##the state chunks are views into the windows, they are no longer valid after freeing
+    state.clear()
+    del seg
+    for key in list(c.shared_wins.keys()):
+        c.shared_wins.pop(key).Free()
+    if c.debug:
+        print(' done.\n')
+
+    return fields
+
+
 def transpose_obs_to_lobs(c, input_obs, ensemble=False):
     """
     Transpose obs from field-complete to ensemble-complete
@@ -187,6 +807,10 @@ def transpose_obs_to_lobs(c, input_obs, ensemble=False):
     Step 2: Gather all obs_rec_id within comm_rec, so that each pid_rec will have the
             entire obs record for assimilation
 
+    The obs are exchanged in the packed form from pack_lobs(), where the obs shared by
+    several partitions on dst_pid are sent only once, and are unpacked into separate
+    partitions after step 2.
+
     Requires attributes in config:
     - c: config obj
     - input_obs: obs_seq from process_all_obs() or obs_prior_seq from process_all_obs_priors()
@@ -233,10 +857,10 @@ def transpose_obs_to_lobs(c, input_obs, ensemble=False):
             if m < len(c.mem_list[c.pid_mem]):
                 mem_id = c.mem_list[c.pid_mem][m]
                 if ensemble:  ##this is the obs prior seq
-                    seq = input_obs[mem_id, obs_rec_id].copy()
+                    seq = input_obs[mem_id, obs_rec_id]
                 else:
                     if mem_id == 0:  ##this is the obs seq, just let mem_id=0 send it
-                        seq = input_obs[obs_rec_id].copy()
+                        seq = input_obs[obs_rec_id]
 
             ##the collective send/recv follows the same idea under state.transpose_field_to_state
             ##1) receive lobs_seq from src_pid, for src_pid<pid first
@@ -252,41 +876,20 @@ def transpose_obs_to_lobs(c, input_obs, ensemble=False):
             ##2) send my obs chunk to a list of dst_pid, send to dst_pid>=pid first
             ##   then cycle back to send to dst_pid<pid. i.e. the dst_pid sequence is
             ##   [pid, pid+1, ..., nproc-1, 0, 1, ..., pid-1]
-            if m < len(c.mem_list[c.pid_mem]):
+            if m < len(c.mem_list[c.pid_mem]) and (ensemble or mem_id == 0):
                 for dst_pid in np.mod(np.arange(c.nproc_mem)+c.pid_mem, c.nproc_mem):
-                    if ensemble:
-                        ##this is the obs prior seq for mem_id, obs_rec_id
-                        ##for each par_id, assemble the subset lobs_seq using obs_inds
-                        lobs_seq = {}
-                        for par_id in c.par_list[dst_pid]:
-                            inds = c.obs_inds[obs_rec_id][par_id]
-                            lobs_seq[par_id] = seq[..., inds]
-
-                        if dst_pid == c.pid_mem:
-                            ##pid already stores the lobs_seq, just copy
-                            tmp_obs[mem_id, obs_rec_id] = lobs_seq
-                        else:
-                            ##send lobs_seq to dst_pid
-                            c.comm_mem.send(lobs_seq, dest=dst_pid, tag=m)
+                    ##this is the obs prior seq for mem_id, obs_rec_id, or the obs seq
+                    ##with keys 'obs','err_std','x','y','z','t' (sent by mem_id=0),
+                    ##packed for the partitions on dst_pid
+                    lobs_pack = pack_lobs(c, seq, obs_rec_id, c.par_list[dst_pid])
+                    key = (mem_id, obs_rec_id) if ensemble else obs_rec_id
 
+                    if dst_pid == c.pid_mem:
+                        ##pid already stores the lobs_seq, just copy
+                        tmp_obs[key] = lobs_pack
                     else:
-                        if mem_id == 0:
-                            ##this is the obs seq with keys 'obs','err_std','x','y','z','t'
-                            ##assemble the lobs_seq dict with same keys but subset obs_inds
-                            ##do this for each par_id to get the full lobs_seq
-                            lobs_seq = {}
-                            for par_id in c.par_list[dst_pid]:
-                                lobs_seq[par_id] = {}
-                                inds = c.obs_inds[obs_rec_id][par_id]
-                                for key in ('obs', 'err_std', 'x', 'y', 'z', 't'):
-                                    lobs_seq[par_id][key] = seq[key][..., inds]
-
-                            if dst_pid == c.pid_mem:
-                                ##pid already stores the lobs_seq, just copy
-                                tmp_obs[obs_rec_id] = lobs_seq
-                            else:
-                                ##send lobs_seq to dst_pid's lobs
-                                c.comm_mem.send(lobs_seq, dest=dst_pid, tag=m)
+                        ##send lobs_seq to dst_pid
+                        c.comm_mem.send(lobs_pack, dest=dst_pid, tag=m)
 
             ##3) finish receiving lobs_seq from src_pid, for src_pid>pid now
             for src_pid in np.arange(c.pid_mem+1, c.nproc_mem):
@@ -303,10 +906,12 @@ def transpose_obs_to_lobs(c, input_obs, ensemble=False):
 
     ##Step 2: collect all obs records (all obs_rec_ids) on pid_rec
     ##        tmp_obs -> output_obs
+    ##all pid_rec in comm_rec share the same pid_mem (par_list), and they all need
+    ##every obs record, so the packed records are gathered and then unpacked
     output_obs = {}
     for entry in c.comm_rec.allgather(tmp_obs):
-        for key, data in entry.items():
-            output_obs[key] = data
+        for key, lobs_pack in entry.items():
+            output_obs[key] = unpack_lobs(lobs_pack)
 
     return output_obs
 
@@ -350,9 +955,9 @@ def transpose_lobs_to_obs(c, lobs):
                 mem_id = c.mem_list[c.pid_mem][m]
                 rec = c.obs_info['records'][obs_rec_id]
                 if rec['is_vector']:
-                    seq = np.full((2, rec['nobs']), np.nan)
+                    seq = np.full((2, rec['nobs']), np.nan, dtype=type_convert[c.state_dtype])
                 else:
-                    seq = np.full((rec['nobs'],), np.nan)
+                    seq = np.full((rec['nobs'],), np.nan, dtype=type_convert[c.state_dtype])
 
             ##this is just the reverse of transpose_obs_to_lobs
             ## we take the exact steps, but swap send and recv operations here
@@ -395,6 +1000,143 @@ def transpose_lobs_to_obs(c, lobs):
     return obs_seq
 
 
+def transpose_z_mean_to_state(c):
+    """
+    Distribute the ensemble mean z coords to the partitions, instead of transposing
+    the z fields of every member. pid_mem=0 reads the mean z fields in its rec_list
+    from z_coords.bin (written by output_ens_mean) and scatters the chunks in comm_mem.
+
+    Inputs:
+    - c: config module
+
+    Returns:
+    - z_state: dict[rec_id, dict[par_id, z_chk]]
+      The ensemble mean z chunks for rec_id in rec_list on partitions in par_list
+    """
+    print = by_rank(c.comm, c.pid_show)(print_with_cache)
+    if c.debug:
+        print('scatter ensemble mean z coords\n')
+
+    if c.pid_mem == 0:
+        z_file = os.path.join(c.work_dir, 'cycle', t2s(c.time), 'analysis', c.s_dir, 'z_coords.bin')
+        z_chk = [{} for _ in range(c.nproc_mem)]
+        for rec_id in c.rec_list[c.pid_rec]:
+            nv = 2 if c.state_info['fields'][rec_id]['is_vector'] else 1
+            z = read_field(z_file, c.state_info, c.mask, 0, rec_id, c.state_dtype, c.state_index['inds'])
+            z = z.reshape((nv, -1))
+            for dst_pid in range(c.nproc_mem):
+                z_chk[dst_pid][rec_id] = {}
+                for par_id in c.par_list[dst_pid]:
+                    inds = c.state_index['par_inds'][par_id]
+                    z_chk[dst_pid][rec_id][par_id] = z[:, inds] if nv == 2 else z[0, inds]
+    else:
+        z_chk = None
+
+    return c.comm_mem.scatter(z_chk, root=0)
+
+
+def transpose_forward_fused(c, fields_prior, z_fields, obs_seq, obs_prior_seq):
+    """
+    Fused version of the transposes in transpose_forward: for each member step m,
+    the state chunks of all records, their z chunks, the obs prior slices (and the
+    obs slices, sent along with mem_id=0) for the partitions of dst_pid are sent in
+    a single message, following the same cyclic send/recv as transpose_field_to_state.
+    The obs (priors) are sent in the packed form from pack_lobs().
+
+    z fields shared by several records (see prepare_state) are sent once per message,
+    the z_state entries of these records point to the same chunks. With c.transpose_z_mean,
+    z is left out of the messages and distributed by transpose_z_mean_to_state instead.
+
+    Inputs/Returns: same as transpose_forward
+    """
+    print = by_rank(c.comm, c.pid_show)(print_with_cache)
+    if c.debug:
+        print('transpose state, z coords, obs and obs priors (fused)\n')
+    rec_list = c.rec_list[c.pid_rec]
+    obs_rec_list = c.obs_rec_list[c.pid_rec]
+
+    def pack(mem_id, dst_pid):
+        msg = {'state':{}, 'z':{}, 'z_key':{}, 'obs_prior':{}}
+        for rec_id in rec_list:
+            nv = 2 if c.state_info['fields'][rec_id]['is_vector'] else 1
+            fld = fields_prior[mem_id, rec_id].reshape((nv, -1))
+            z = z_fields[mem_id, rec_id]
+            z = z[0] if nv == 2 else z
+            z_key = z.__array_interface__['data'][0]  ##identify shared z by its memory address
+            msg['state'][rec_id] = {}
+            msg['z_key'][rec_id] = z_key
+            if z_key not in msg['z']:
+                msg['z'][z_key] = {}
+            for par_id in c.par_list[dst_pid]:
+                inds = c.state_index['par_inds'][par_id]
+                msg['state'][rec_id][par_id] = fld[:, inds] if nv == 2 else fld[0, inds]
+                if not c.transpose_z_mean:
+                    msg['z'][z_key][par_id] = z.reshape(-1)[inds]
+        for obs_rec_id in obs_rec_list:
+            msg['obs_prior'][obs_rec_id] = pack_lobs(c, obs_prior_seq[mem_id, obs_rec_id], obs_rec_id, c.par_list[dst_pid])
+        if mem_id == 0:
+            ##the obs seq is the same for all members, only sent with mem_id=0
+            msg['obs'] = {obs_rec_id: pack_lobs(c, obs_seq[obs_rec_id], obs_rec_id, c.par_list[dst_pid])
+                          for obs_rec_id in obs_rec_list}
+        return msg
+
+    state_prior, z_state, tmp_lobs, tmp_lobs_prior = {}, {}, {}, {}
+    def unpack(mem_id, msg):
+        for rec_id in rec_list:
+            state_prior[mem_id, rec_id] = msg['state'][rec_id]
+            if c.transpose_z_mean:
+                continue
+            z = msg['z'][msg['z_key'][rec_id]]
+            if c.state_info['fields'][rec_id]['is_vector']:
+                z_state[mem_id, rec_id] = {par_id: np.broadcast_to(chk, (2,)+chk.shape) for par_id, chk in z.items()}
+            else:
+                z_state[mem_id, rec_id] = z
+        for obs_rec_id in obs_rec_list:
+            tmp_lobs_prior[mem_id, obs_rec_id] = msg['obs_prior'][obs_rec_id]
+        if 'obs' in msg:
+            tmp_lobs.update(msg['obs'])
+
+    nm_max = np.max([len(lst) for p,lst in c.mem_list.items()])
+    for m in range(nm_max):
+        if c.debug:
+            print(progress_bar(m, nm_max))
+
+        ##1) receive from src_pid<pid first
+        for src_pid in np.arange(0, c.pid_mem):
+            if m < len(c.mem_list[src_pid]):
+                unpack(c.mem_list[src_pid][m], c.comm_mem.recv(source=src_pid, tag=m))
+
+        ##2) send to dst_pid in cyclic order [pid, pid+1, ..., nproc-1, 0, 1, ..., pid-1]
+        if m < len(c.mem_list[c.pid_mem]):
+            mem_id = c.mem_list[c.pid_mem][m]
+            for dst_pid in np.mod(np.arange(c.nproc_mem)+c.pid_mem, c.nproc_mem):
+                msg = pack(mem_id, dst_pid)
+                if dst_pid == c.pid_mem:
+                    unpack(mem_id, msg)
+                else:
+                    c.comm_mem.send(msg, dest=dst_pid, tag=m)
+
+        ##3) finish receiving from src_pid>pid
+        for src_pid in np.arange(c.pid_mem+1, c.nproc_mem):
+            if m < len(c.mem_list[src_pid]):
+                unpack(c.mem_list[src_pid][m], c.comm_mem.recv(source=src_pid, tag=m))
+    if c.debug:
+        print(' done.\n')
+
+    ##collect all obs records on pid_rec, obs and obs priors in one allgather
+    lobs, lobs_prior = {}, {}
+    for entry_lobs, entry_lobs_prior in c.comm_rec.allgather((tmp_lobs, tmp_lobs_prior)):
+        for key, lobs_pack in entry_lobs.items():
+            lobs[key] = unpack_lobs(lobs_pack)
+        for key, lobs_pack in entry_lobs_prior.items():
+            lobs_prior[key] = unpack_lobs(lobs_pack)
+
+    if c.transpose_z_mean:
+        z_state = transpose_z_mean_to_state(c)
+
+    return state_prior, z_state, lobs, lobs_prior
+
+
 def transpose_forward(c, fields_prior, z_fields, obs_seq, obs_prior_seq):
     """
     transpose funcs called by assimilate.py
@@ -403,17 +1145,23 @@ def transpose_forward(c, fields_prior, z_fields, obs_seq, obs_prior_seq):
     if c.debug:
         print('tranpose:\n')
 
+    if c.transpose_fused:
+        return comm_section(c, 'forward.fused')(transpose_forward_fused)(c, fields_prior, z_fields, obs_seq, obs_prior_seq)
+
     if c.debug:
         print('state variable fields: ')
-    state_prior = transpose_field_to_state(c, fields_prior)
+    state_prior = comm_section(c, 'forward.state')(transpose_field_to_state)(c, fields_prior)
 
     if c.debug:
         print('z coords fields: ')
-    z_state = transpose_field_to_state(c, z_fields)
+    if c.transpose_z_mean:
+        z_state = comm_section(c, 'forward.z_coords')(transpose_z_mean_to_state)(c)
+    else:
+        z_state = comm_section(c, 'forward.z_coords')(transpose_field_to_state)(c, z_fields)
 
-    lobs = transpose_obs_to_lobs(c, obs_seq)
+    lobs = comm_section(c, 'forward.obs')(transpose_obs_to_lobs)(c, obs_seq)
 
-    lobs_prior = transpose_obs_to_lobs(c, obs_prior_seq, ensemble=True)
+    lobs_prior = comm_section(c, 'forward.obs_prior')(transpose_obs_to_lobs)(c, obs_prior_seq, ensemble=True)
 
     return state_prior, z_state, lobs, lobs_prior
 
@@ -424,9 +1172,9 @@ def transpose_backward(c, state_post, lobs_post):
     if c.debug:
         print('transpose back:\n')
 
-    fields_post = transpose_state_to_field(c, state_post)
+    fields_post = comm_section(c, 'backward.state')(transpose_state_to_field)(c, state_post)
 
-    obs_post_seq = transpose_lobs_to_obs(c, lobs_post)
+    obs_post_seq = comm_section(c, 'backward.obs_post')(transpose_lobs_to_obs)(c, lobs_post)
 
     return fields_post, obs_post_seq
 
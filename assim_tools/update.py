@@ -5,7 +5,7 @@ import os
 from utils.parallel import by_rank
 from utils.conversion import type_convert, type_dic, type_size, t2h, h2t, t2s, s2t
 from utils.progress import print_with_cache, progress_bar
-from .state import read_field
+from .state import open_state_file, read_field
 
 def update_restart(c, fields_prior, fields_post):
     """
@@ -31,14 +31,20 @@ def update_restart(c, fields_prior, fields_post):
     nm = len(c.mem_list[c.pid_mem])
     nr = len(c.rec_list[c.pid_rec])
 
+    ##the mean files depend on the time of the record, each is opened once and kept by path
+    mean_files = {}
+    def mean_file(name, time):
+        path = os.path.join(c.work_dir,'cycle',t2s(time),'analysis',name)
+        if path not in mean_files:
+            mean_files[path] = open_state_file(path, c.state_info)
+        return mean_files[path]
+
     for r, rec_id in enumerate(c.rec_list[c.pid_rec]):
         rec = c.state_info['fields'][rec_id]
 
         ##read the prior and post mean field with rec_id
-        prior_mean_file = os.path.join(c.work_dir,'cycle',t2s(rec['time']),'analysis','prior_mean_state.bin')
-        fld_prior_mean = read_field(prior_mean_file, c.state_info, c.mask, 0, rec_id)
-        post_mean_file = os.path.join(c.work_dir,'cycle',t2s(rec['time']),'analysis','post_mean_state.bin')
-        fld_post_mean = read_field(post_mean_file, c.state_info, c.mask, 0, rec_id)
+        fld_prior_mean = read_field(mean_file('prior_mean_state.bin', rec['time']), c.state_info, c.mask, 0, rec_id, inds=c.state_index['inds'])
+        fld_post_mean = read_field(mean_file('post_mean_state.bin', rec['time']), c.state_info, c.mask, 0, rec_id, inds=c.state_index['inds'])
 
         for m, mem_id in enumerate(c.mem_list[c.pid_mem]):
             if c.debug:
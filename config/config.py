@@ -28,7 +28,7 @@ class Config(object):
         self.set_model_config()
 
         ##these attributes will also be useful during runtime
-        for key in ['state_info','mem_list','rec_list','partitions','obs_info','obs_rec_list','obs_inds','par_list']:
+        for key in ['state_info','mem_list','rec_list','partitions','state_index','obs_info','obs_rec_list','obs_inds','pid_mem_node','par_list','checkpoint_dir']:
             setattr(self, key, None)
 
 
@@ -1,17 +1,23 @@
 import numpy as np
 from utils.netcdf_lib import nc_write_var
 from utils.conversion import t2h, h2t
-from assim_tools.state import read_state_info, read_field
+from assim_tools.state import read_state_info, mask_checksum, open_state_file, read_field
 
 import sys
 filename = sys.argv[1]
-nens = int(sys.argv[2])
 
 ##convert bin file state variables [nfield, ny, nx] * nens
 ##to nc files [nens, nt, nz, ny, nx] * num_var files
 info = read_state_info(filename)
+
+##number of members, given in the .json header, or as the second argument
+nens = int(sys.argv[2]) if len(sys.argv) > 2 else info['nens']
+
 dims = {'member':None, 'time':None, 'level':None, 'y':info['ny'], 'x':info['nx']}
 mask = np.full((info['ny'], info['nx']), False, dtype=bool)
+if 'mask_checksum' in info:
+    assert info['mask_checksum'] == mask_checksum(mask), 'state file is written with masked points, cannot convert without the mask'
+f = open_state_file(filename, info)
 
 for v in list(set(rec['name'] for i, rec in info['fields'].items())):
     print('converting '+v)
@@ -24,7 +30,7 @@ for v in list(set(rec['name'] for i, rec in info['fields'].items())):
     for rec_id, rec in [(i,r) for i,r in info['fields'].items() if r['name']==v]:
         for mem_id in range(nens):
             ##get the field from bin file
-            fld = read_field(filename, info, mask, mem_id, rec_id)
+            fld = read_field(f, info, mask, mem_id, rec_id)
             ##get record number along time,level dimensions
             id_time = [i for i,t in enumerate(times) if t2h(rec['time'])==t][0]
             id_level = [i for i,z in enumerate(levels) if rec['k']==z][0]
@@ -2,16 +2,19 @@ import numpy as np
 import os
 from config import Config
 from utils.conversion import t2s, s2t, dt1h
-from utils.parallel import bcast_by_root
-from utils.progress import timer
-from assim_tools.state import parse_state_info, distribute_state_tasks, partition_grid, prepare_state, output_state, output_ens_mean
+from utils.parallel import bcast_by_root, node_ids, instrument_comm, report_comm_stats
+from utils.progress import timer, peak_memory
+from utils.checkpoint import checkpoint, checkpoint_dir, clean_checkpoint
+from assim_tools.state import parse_state_info, distribute_state_tasks, partition_grid, build_state_index, prepare_state, output_state, output_ens_mean, StateFileFields
 from assim_tools.obs import parse_obs_info, distribute_obs_tasks, prepare_obs, prepare_obs_from_state, assign_obs, distribute_partitions
-from assim_tools.transpose import transpose_forward, transpose_backward
+from assim_tools.transpose import transpose_forward, transpose_backward, report_transpose_traffic
 from assim_tools.analysis import batch_assim, serial_assim
 from assim_tools.inflation import inflate_state, adaptive_prior_inflation, adaptive_post_inflation, adaptive_relaxation
 from assim_tools.update import update_restart
 
 c = Config(parse_args=True)
+if c.comm_stats:
+    instrument_comm(c)
 
 ##the algorithm can be iterated over several scale components
 ##for s = 0, ..., nscale
@@ -23,10 +26,15 @@ if c.pid == 0:
         os.makedirs(analysis_dir)
 c.comm.Barrier()
 
+##the checkpoint dir is fixed at the start, the config hash changes once adaptive
+##inflation/relaxation updates inflate_coef and relax_coef
+c.checkpoint_dir = checkpoint_dir(c)
+
 c.state_info = bcast_by_root(c.comm)(parse_state_info)(c)
 c.mem_list, c.rec_list = bcast_by_root(c.comm)(distribute_state_tasks)(c)
 c.partitions = bcast_by_root(c.comm)(partition_grid)(c)
-fields_prior, z_fields = timer(c)(prepare_state)(c)
+c.state_index = build_state_index(c)
+fields_prior, z_fields = timer(c)(checkpoint(c, 'fields_prior')(prepare_state))(c)
 
 # mem_list, rec_list = build_state_tasks(c, state_info)
 # # if c.pid_rec == 0:
@@ -37,28 +45,35 @@ fields_prior, z_fields = timer(c)(prepare_state)(c)
 # if c.debug:
 #     np.save(analysis_dir+'/fields_prior.{}.{}.npy'.format(c.pid_mem, c.pid_rec), fields_prior)
 
-timer(c)(output_state)(c, fields_prior, os.path.join(analysis_dir,'prior_state.bin'))
-timer(c)(output_ens_mean)(c, fields_prior, os.path.join(analysis_dir,'prior_mean_state.bin'))
+##in low memory mode without prior inflation, prior_state.bin is read back by update_restart,
+##the perturbations must not be lost to state_file_keepbits/downcast
+timer(c)(output_state)(c, fields_prior, os.path.join(analysis_dir,'prior_state.bin'),
+                       lossless=c.low_memory and 'prior' not in c.inflate_type)
+spread_file = os.path.join(analysis_dir,'prior_spread_state.bin') if c.output_ens_spread else None
+timer(c)(output_ens_mean)(c, fields_prior, os.path.join(analysis_dir,'prior_mean_state.bin'), spread_file)
 
 timer(c)(output_ens_mean)(c, z_fields, os.path.join(analysis_dir,'z_coords.bin'))
 c.comm.Barrier()
 
 c.obs_info = bcast_by_root(c.comm)(parse_obs_info)(c)
 c.obs_rec_list = bcast_by_root(c.comm)(distribute_obs_tasks)(c)
-obs_seq = timer(c)(bcast_by_root(c.comm_mem)(prepare_obs))(c)
+obs_seq = timer(c)(checkpoint(c, 'obs_seq')(bcast_by_root(c.comm_mem)(prepare_obs)))(c)
 
 if c.pid_mem == 0:
     np.save(analysis_dir+'/obs_seq.{}.npy'.format(c.pid_rec), obs_seq)
 
-c.obs_inds = bcast_by_root(c.comm_mem)(assign_obs)(c, obs_seq)
-c.par_list = bcast_by_root(c.comm)(distribute_partitions)(c)
+c.obs_inds = checkpoint(c, 'obs_inds')(bcast_by_root(c.comm_mem)(assign_obs))(c, obs_seq)
+c.par_list = checkpoint(c, 'par_list')(bcast_by_root(c.comm)(distribute_partitions))(c)
+if c.debug:
+    c.pid_mem_node = node_ids(c.comm_mem)
+    report_transpose_traffic(c)
 
 # if c.pid == 0 and c.debug:
 #     np.save(analysis_dir+'/obs_inds.npy', obs_inds)
 #     np.save(analysis_dir+'/partitions.npy', partitions)
 #     np.save(analysis_dir+'/par_list.npy', par_list)
 
-obs_prior_seq = timer(c)(prepare_obs_from_state)(c, obs_seq, fields_prior, z_fields)
+obs_prior_seq = timer(c)(checkpoint(c, 'obs_prior_seq')(prepare_obs_from_state))(c, obs_seq, fields_prior, z_fields)
 c.comm.Barrier()
 
 # if c.debug:
@@ -70,26 +85,49 @@ if 'prior' in c.inflate_type:
         adaptive_prior_inflation(c, obs_seq, obs_prior_seq)
     inflate_state(c, fields_prior, os.path.join(analysis_dir,'prior_mean_state.bin'))
 
-state_prior, z_state, lobs, lobs_prior = transpose_forward(c, fields_prior, z_fields, obs_seq, obs_prior_seq)
-c.comm.Barrier()
-
-# if c.debug:
-#     np.save(analysis_dir+'/state_prior.{}.{}.npy'.format(c.pid_mem, c.pid_rec), state_prior)
-#     np.save(analysis_dir+'/z_state.{}.{}.npy'.format(c.pid_mem, c.pid_rec), z_state)
-#     np.save(analysis_dir+'/lobs.{}.{}.npy'.format(c.pid_mem, c.pid_rec), lobs)
-#     np.save(analysis_dir+'/lobs_prior.{}.{}.npy'.format(c.pid_mem, c.pid_rec), lobs_prior)
-
-if c.assim_mode == 'batch':
-    assim = timer(c)(batch_assim)
-elif c.assim_mode == 'serial':
-    assim = timer(c)(serial_assim)
-
-state_post, lobs_post = assim(c, state_prior, z_state, lobs, lobs_prior)
+##in low memory mode, the (inflated) prior fields are kept on disk for update_restart
+##instead of in memory during the analysis
+if c.low_memory:
+    if 'prior' in c.inflate_type:
+        prior_file = os.path.join(analysis_dir,'prior_inflated_state.bin')
+        timer(c)(output_state)(c, fields_prior, prior_file, lossless=True)
+    else:
+        prior_file = os.path.join(analysis_dir,'prior_state.bin')
+
+##transpose to ensemble-complete and run the assimilation
+##(the two are together a single stage for checkpointing)
+def analysis(c, fields_prior, z_fields, obs_seq, obs_prior_seq):
+    state_prior, z_state, lobs, lobs_prior = transpose_forward(c, fields_prior, z_fields, obs_seq, obs_prior_seq)
+    c.comm.Barrier()
+
+    if c.low_memory:
+        ##the field-complete fields are not needed until update_restart
+        fields_prior.clear()
+        z_fields.clear()
+
+    # if c.debug:
+    #     np.save(analysis_dir+'/state_prior.{}.{}.npy'.format(c.pid_mem, c.pid_rec), state_prior)
+    #     np.save(analysis_dir+'/z_state.{}.{}.npy'.format(c.pid_mem, c.pid_rec), z_state)
+    #     np.save(analysis_dir+'/lobs.{}.{}.npy'.format(c.pid_mem, c.pid_rec), lobs)
+    #     np.save(analysis_dir+'/lobs_prior.{}.{}.npy'.format(c.pid_mem, c.pid_rec), lobs_prior)
+
+    if c.assim_mode == 'batch':
+        assim = timer(c)(batch_assim)
+    elif c.assim_mode == 'serial':
+        assim = timer(c)(serial_assim)
+
+    return assim(c, state_prior, z_state, lobs, lobs_prior)
+
+state_post, lobs_post = checkpoint(c, 'state_post')(analysis)(c, fields_prior, z_fields, obs_seq, obs_prior_seq)
+if c.low_memory:
+    fields_prior = StateFileFields(c, prior_file)
+    del z_fields
 
 fields_post, obs_post_seq = transpose_backward(c, state_post, lobs_post)
 c.comm.Barrier()
 
-timer(c)(output_ens_mean)(c, fields_post, os.path.join(analysis_dir,'post_mean_state.bin'))
+spread_file = os.path.join(analysis_dir,'post_spread_state.bin') if c.output_ens_spread else None
+timer(c)(output_ens_mean)(c, fields_post, os.path.join(analysis_dir,'post_mean_state.bin'), spread_file)
 
 ##posterior inflation
 if 'posterior' in c.inflate_type:
@@ -104,6 +142,14 @@ timer(c)(output_state)(c, fields_post, os.path.join(analysis_dir,'post_state.bin
 
 timer(c)(update_restart)(c, fields_prior, fields_post)
 
+clean_checkpoint(c)
+
+if c.low_memory or c.debug:
+    peak_memory(c)
+
+if c.comm_stats:
+    report_comm_stats(c, os.path.join(analysis_dir, 'comm_stats.json'))
+
 # ##optional: output posterior obs for diag
 # # obs_post_seq = prepare_obs_from_state(c, state_info, mem_list, rec_list, obs_info, obs_list, obs_seq, fields_post, z_fields)
 # # output_obs(c, obs_info, obs_post_seq)
@@ -0,0 +1,59 @@
+##benchmark the 'jit' and 'blas3' batch_kernel for the local analysis of one partition
+##usage: python bench_batch_kernel.py [--nens NENS --nloc NLOC --nobs NOBS --nvar NVAR --nlev NLEV --batch_mem MB]
+##the state has nvar variables on the same nlev levels, stored variable by variable as in rec_list
+import numpy as np
+import argparse
+import time
+from types import SimpleNamespace
+from assim_tools.analysis import local_analysis_loop, local_analysis_blas3
+from assim_tools.localization import build_obs_bins
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--nens', type=int, default=40)
+parser.add_argument('--nloc', type=int, default=2000)     ##number of grid points in the partition
+parser.add_argument('--nobs', type=int, default=4000)     ##number of local obs of the partition
+parser.add_argument('--nvar', type=int, default=4)
+parser.add_argument('--nlev', type=int, default=5)
+parser.add_argument('--hroi', type=float, default=8.)
+parser.add_argument('--vroi', type=float, default=3.)
+parser.add_argument('--batch_mem', type=float, default=256)
+parser.add_argument('--repeat', type=int, default=3)
+args = parser.parse_args()
+
+L = 100.  ##partition size, in grid points
+rng = np.random.default_rng(0)
+nfld = args.nvar * args.nlev
+lev = np.tile(np.arange(args.nlev, dtype=float), args.nvar)  ##level of each field
+state_data = {'state_prior': rng.normal(size=(args.nens, nfld, args.nloc)),
+              'x': rng.uniform(0, L, args.nloc), 'y': rng.uniform(0, L, args.nloc),
+              'z': np.repeat(lev[:, None], args.nloc, axis=1), 't': np.zeros(nfld)}
+obs_data = {'obs': rng.normal(size=args.nobs), 'err_std': np.ones(args.nobs),
+            'x': rng.uniform(0, L, args.nobs), 'y': rng.uniform(0, L, args.nobs),
+            'z': rng.uniform(0, args.nlev, args.nobs), 't': np.zeros(args.nobs),
+            'obs_prior': rng.normal(size=(args.nens, args.nobs)),
+            'hroi': np.full(args.nobs, args.hroi), 'vroi': np.full(args.nobs, args.vroi), 'troi': np.ones(args.nobs)}
+obs_bins = build_obs_bins(obs_data['x'], obs_data['y'], args.hroi)
+c = SimpleNamespace(blas3_batch_mem=args.batch_mem, localize_type='GC', filter_type='ETKF')
+
+def run_jit(state):
+    local_analysis_loop(state, state_data['x'], state_data['y'], state_data['z'], state_data['t'],
+                        obs_data['obs'], obs_data['err_std'], obs_data['x'], obs_data['y'], obs_data['z'], obs_data['t'],
+                        obs_data['obs_prior'], obs_data['hroi'], obs_data['vroi'], obs_data['troi'],
+                        obs_bins, 1, c.localize_type, c.filter_type)
+
+def run_blas3(state):
+    local_analysis_blas3(c, dict(state_data, state_prior=state), obs_data, obs_bins)
+
+print(f'nens={args.nens}, nloc={args.nloc}, nobs={args.nobs}, nfld={args.nvar}x{args.nlev}, hroi={args.hroi}, vroi={args.vroi}')
+run_jit(state_data['state_prior'].copy())  ##compile
+state_ref = None
+for name, func in [('jit', run_jit), ('blas3', run_blas3)]:
+    timings = []
+    for i in range(args.repeat):
+        state = state_data['state_prior'].copy()
+        t0 = time.time()
+        func(state)
+        timings.append(time.time() - t0)
+    if state_ref is None:
+        state_ref = state
+    print(f'{name:>8} {np.min(timings):8.3f} s, max diff {np.max(np.abs(state - state_ref)):.1e}')
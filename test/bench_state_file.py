@@ -0,0 +1,96 @@
+##benchmark the i/o time and file size of the state file formats
+##usage: python bench_state_file.py [--nx NX --ny NY --nens NENS --nrec NREC]
+##       (can also run with mpiexec -np N)
+import numpy as np
+import os
+import argparse
+import shutil
+import tempfile
+import time
+from types import SimpleNamespace
+from datetime import datetime
+from utils.parallel import Comm
+from assim_tools.state import distribute_state_tasks, partition_grid, build_state_index, output_state, output_ens_mean, open_state_file, read_field
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--nx', type=int, default=500)
+parser.add_argument('--ny', type=int, default=400)
+parser.add_argument('--nens', type=int, default=10)
+parser.add_argument('--nrec', type=int, default=10)
+parser.add_argument('--dtype', default='double')
+parser.add_argument('--dir', default=None)
+args = parser.parse_args()
+
+##synthetic config with state_info, mask and task lists
+c = SimpleNamespace(nx=args.nx, ny=args.ny, nens=args.nens, debug=False, pid_show=0, assim_mode='batch')
+c.comm = Comm()
+c.nproc = c.nproc_mem = c.comm.Get_size()
+c.pid = c.pid_mem = c.comm.Get_rank()
+c.pid_rec = 0
+c.comm_mem = c.comm
+c.comm_rec = c.comm.Split(c.pid, 0)
+c.state_file_io = 'posix'
+
+##land mask: a disk in the middle of the domain
+jj, ii = np.mgrid[0:c.ny, 0:c.nx]
+c.mask = np.hypot(ii-c.nx/2, jj-c.ny/2) < min(c.nx, c.ny)/4
+fld_size = np.sum(~c.mask)
+
+c.state_info = {'nx':c.nx, 'ny':c.ny, 'size':0, 'fields':{}}
+pos = 0
+for rec_id in range(args.nrec):
+    c.state_info['fields'][rec_id] = {'name':'var', 'model_src':'synthetic', 'dtype':args.dtype, 'is_vector':False,
+                                      'units':'*', 'err_type':'normal', 'time':datetime(2023,1,1), 'dt':0, 'k':rec_id, 'pos':pos}
+    pos += fld_size * (8 if args.dtype=='double' else 4)
+c.state_info['size'] = pos
+c.mem_list, c.rec_list = distribute_state_tasks(c)
+c.partitions = partition_grid(c)
+c.state_index = build_state_index(c)
+
+##smooth random fields, as the model states usually are
+def smooth_field(seed):
+    rng = np.random.default_rng(seed)
+    kx, ky = np.meshgrid(np.fft.fftfreq(c.nx), np.fft.fftfreq(c.ny))
+    spec = np.fft.fft2(rng.normal(size=(c.ny, c.nx))) * np.exp(-np.hypot(kx, ky)**2 / 0.02**2)
+    return np.real(np.fft.ifft2(spec)) * 100 + 280
+
+fields = {(m, r): smooth_field(m*args.nrec+r) for m in c.mem_list[c.pid_mem] for r in c.rec_list[c.pid_rec]}
+
+##all pid write to the same files, the directory is created by pid 0
+tmpdir = c.comm.bcast(tempfile.mkdtemp(dir=args.dir) if c.pid == 0 else None, root=0)
+if c.pid == 0:
+    print(f'nx={c.nx}, ny={c.ny}, nens={c.nens}, nrec={args.nrec}, dtype={args.dtype}, nproc={c.nproc}')
+    print(f"{'format':>24} {'size (MB)':>10} {'ratio':>7} {'write (s)':>10} {'read (s)':>10} {'max err':>10}")
+
+raw_size = None
+for compress, keepbits, downcast in [('none', 0, False), ('zlib', 0, False), ('zlib', 0, True),
+                                     ('zlib', 16, False), ('zlib', 10, False)]:
+    c.state_file_compress, c.state_file_keepbits, c.state_file_downcast = compress, keepbits, downcast
+    binfile = os.path.join(tmpdir, f'state_{compress}_{keepbits}_{int(downcast)}.bin')
+
+    c.comm.Barrier()
+    t0 = time.time()
+    output_state(c, fields, binfile)
+    c.comm.Barrier()
+    t1 = time.time()
+
+    f = open_state_file(binfile, c.state_info)
+    err = 0.
+    for (m, r), fld in fields.items():
+        fld1 = read_field(f, c.state_info, c.mask, m, r)
+        err = max(err, np.max(np.abs(fld1[~c.mask] - fld[~c.mask])))
+    del f
+    c.comm.Barrier()
+    t2 = time.time()
+    err = np.max(c.comm.allgather(err))
+
+    size = os.path.getsize(binfile) / 2**20
+    if raw_size is None:
+        raw_size = size
+    name = compress + (f', keepbits={keepbits}' if keepbits>0 else '') + (', float' if downcast else '')
+    if c.pid == 0:
+        print(f'{name:>24} {size:10.2f} {raw_size/size:7.2f} {t1-t0:10.3f} {t2-t1:10.3f} {err:10.2e}')
+
+c.comm.Barrier()
+if c.pid == 0:
+    shutil.rmtree(tmpdir)
@@ -0,0 +1,121 @@
+##benchmark the transposes between field-complete and ensemble-complete state and obs
+##usage: mpiexec -np N python bench_transpose.py [--nx NX --ny NY --nens NENS --nrec NREC --nobs NOBS
+##                                               --nproc_mem NPROC_MEM --method METHOD --dtype DTYPE]
+import numpy as np
+import argparse
+import time
+from types import SimpleNamespace
+from datetime import datetime
+from utils.parallel import Comm, distribute_tasks
+from assim_tools.state import distribute_state_tasks, partition_grid, build_state_index
+from assim_tools.transpose import transpose_field_to_state, transpose_state_to_field, transpose_obs_to_lobs, transpose_lobs_to_obs, wait_all
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--nx', type=int, default=500)
+parser.add_argument('--ny', type=int, default=400)
+parser.add_argument('--nens', type=int, default=20)
+parser.add_argument('--nrec', type=int, default=10)
+parser.add_argument('--nobs', type=int, default=10000)    ##number of obs in each obs record
+parser.add_argument('--nobs_rec', type=int, default=4)
+parser.add_argument('--halo', type=int, default=20)       ##obs within halo grid points are assigned to a partition
+parser.add_argument('--nproc_mem', type=int, default=None)
+parser.add_argument('--method', default='sendrecv')       ##transpose_method
+parser.add_argument('--dtype', default='double')          ##state_dtype
+parser.add_argument('--repeat', type=int, default=3)
+args = parser.parse_args()
+
+##synthetic config with the processor layout as in Config.set_comm
+c = SimpleNamespace(nx=args.nx, ny=args.ny, nens=args.nens, debug=False, pid_show=0, assim_mode='batch',
+                    state_dtype=args.dtype, transpose_method=args.method, transpose_batch_size=16,
+                    transpose_fused=False, transpose_z_mean=False, comm_stats=False)
+c.comm = Comm()
+c.nproc = c.comm.Get_size()
+c.pid = c.comm.Get_rank()
+c.nproc_mem = args.nproc_mem if args.nproc_mem else c.nproc
+c.nproc_rec = c.nproc // c.nproc_mem
+c.pid_mem = c.pid % c.nproc_mem
+c.pid_rec = c.pid // c.nproc_mem
+c.comm_mem = c.comm.Split(c.pid_rec, c.pid_mem)
+c.comm_rec = c.comm.Split(c.pid_mem, c.pid_rec)
+
+##land mask: a disk in the middle of the domain
+jj, ii = np.mgrid[0:c.ny, 0:c.nx]
+c.mask = np.hypot(ii-c.nx/2, jj-c.ny/2) < min(c.nx, c.ny)/4
+
+##state records, every third one is a vector field
+c.state_info = {'nx':c.nx, 'ny':c.ny, 'size':0, 'fields':{}}
+fld_size = np.sum(~c.mask)
+pos = 0
+for rec_id in range(args.nrec):
+    is_vector = (rec_id % 3 == 0)
+    c.state_info['fields'][rec_id] = {'name':'var', 'model_src':'synthetic', 'dtype':'double', 'is_vector':is_vector,
+                                      'units':'*', 'err_type':'normal', 'time':datetime(2023,1,1), 'dt':0, 'k':rec_id, 'pos':pos}
+    pos += (2 if is_vector else 1) * fld_size * 8
+c.state_info['size'] = pos
+c.mem_list, c.rec_list = distribute_state_tasks(c)
+c.partitions = partition_grid(c)
+c.state_index = build_state_index(c)
+c.par_list = distribute_tasks(c.comm_mem, np.arange(len(c.partitions)), np.array(list(c.state_index['par_size'].values()))+1)
+
+##obs records with random locations, assigned to the partitions within halo
+rng = np.random.default_rng(0)
+c.obs_info = {'records':{}}
+c.obs_inds = {}
+for obs_rec_id in range(args.nobs_rec):
+    is_vector = (obs_rec_id % 2 == 1)
+    c.obs_info['records'][obs_rec_id] = {'is_vector':is_vector, 'nobs':args.nobs}
+    x = rng.uniform(0, c.nx, args.nobs)
+    y = rng.uniform(0, c.ny, args.nobs)
+    c.obs_inds[obs_rec_id] = {par_id: np.where((x >= ist-args.halo) & (x < ied+args.halo) & (y >= jst-args.halo) & (y < jed+args.halo))[0]
+                              for par_id, (ist,ied,di,jst,jed,dj) in enumerate(c.partitions)}
+c.obs_rec_list = distribute_tasks(c.comm_rec, np.arange(args.nobs_rec))
+
+dtype = np.float64 if args.dtype == 'double' else np.float32
+fields = {}
+for mem_id in c.mem_list[c.pid_mem]:
+    for rec_id in c.rec_list[c.pid_rec]:
+        shape = (2, c.ny, c.nx) if c.state_info['fields'][rec_id]['is_vector'] else (c.ny, c.nx)
+        fields[mem_id, rec_id] = rng.normal(size=shape).astype(dtype)
+obs_prior_seq = {}
+for mem_id in c.mem_list[c.pid_mem]:
+    for obs_rec_id in c.obs_rec_list[c.pid_rec]:
+        shape = (2, args.nobs) if c.obs_info['records'][obs_rec_id]['is_vector'] else (args.nobs,)
+        obs_prior_seq[mem_id, obs_rec_id] = rng.normal(size=shape).astype(dtype)
+
+##total data volume moved by each transpose, for the throughput
+itemsize = np.dtype(dtype).itemsize
+state_nbytes = c.nens * np.sum([(2 if rec['is_vector'] else 1) for rec in c.state_info['fields'].values()]) * fld_size * itemsize
+obs_nbytes = c.nens * np.sum([(2 if rec['is_vector'] else 1) for rec in c.obs_info['records'].values()]) * args.nobs * itemsize
+
+def timed(func, *args):
+    c.comm.Barrier()
+    t0 = time.time()
+    result = func(*args)
+    if c.transpose_method == 'nonblocking':
+        wait_all(c)
+    c.comm.Barrier()
+    return result, time.time() - t0
+
+if c.pid == 0:
+    print(f'nx={c.nx}, ny={c.ny}, nens={c.nens}, nrec={args.nrec}, nobs={args.nobs}x{args.nobs_rec}, dtype={args.dtype}, '
+          f'nproc={c.nproc}, nproc_mem={c.nproc_mem}, method={c.transpose_method}')
+    print(f"{'transpose':>26} {'size (MB)':>10} {'time (s)':>10} {'GB/s':>8}")
+
+timings = {name: [] for name in ('field_to_state', 'state_to_field', 'obs_to_lobs', 'lobs_to_obs')}
+for i in range(args.repeat):
+    state, t = timed(transpose_field_to_state, c, fields)
+    timings['field_to_state'].append(t)
+    fields_out, t = timed(transpose_state_to_field, c, state)
+    timings['state_to_field'].append(t)
+    lobs_prior, t = timed(transpose_obs_to_lobs, c, obs_prior_seq, True)
+    timings['obs_to_lobs'].append(t)
+    obs_out, t = timed(transpose_lobs_to_obs, c, lobs_prior)
+    timings['lobs_to_obs'].append(t)
+    del state, fields_out, lobs_prior, obs_out
+
+if c.pid == 0:
+    for name, nbytes in [('field_to_state', state_nbytes), ('state_to_field', state_nbytes),
+                         ('obs_to_lobs', obs_nbytes), ('lobs_to_obs', obs_nbytes)]:
+        ##best of the repeats
+        t = np.min(timings[name])
+        print(f'{name:>26} {nbytes/2**20:10.2f} {t:10.3f} {nbytes/t/1e9:8.3f}')
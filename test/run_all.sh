@@ -11,6 +11,16 @@ echo
 echo 'test Grid class:'
 python -m unittest test_grid.py
 echo
+echo 'test state file io:'
+echo 'test with 4 processors'
+mpiexec -np 4 python -m unittest test_state.py
+echo
+echo 'test with 1 processor'
+python -m unittest test_state.py
+echo
 echo 'test analysis lib:'
 python -m unittest test_analysis.py
 echo
+echo 'test inflation:'
+python -m unittest test_inflation.py
+echo
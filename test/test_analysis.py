@@ -1,6 +1,23 @@
 import numpy as np
 import unittest
+from unittest import mock
+from types import SimpleNamespace
 from assim_tools.analysis import *
+from assim_tools.localization import build_obs_bins, nearby_obs
+
+def svd_transform_weights(obs, obs_err, obs_prior, filter_type, local_factor):
+    ##reference weights from the SVD of the full nens-sized I + S^T S
+    nens, nlobs = obs_prior.shape
+    obs_prior_mean = np.mean(obs_prior, axis=0)
+    S = ((obs_prior - obs_prior_mean) * local_factor / obs_err).T / np.sqrt(nens-1)
+    dy = (obs - obs_prior_mean) * local_factor / obs_err / np.sqrt(nens-1)
+    L, sv, Rh = np.linalg.svd(np.eye(nens) + S.T @ S)
+    gain = L @ np.diag(sv**-1) @ Rh @ S.T
+    weights = np.repeat((gain @ dy)[:, None], nens, axis=1)
+    if filter_type == 'ETKF':
+        return weights + L @ np.diag(sv**-0.5) @ Rh
+    return weights + np.eye(nens) - 0.5 * gain @ S
+
 
 class TestAnalysis(unittest.TestCase):
 
@@ -17,6 +34,155 @@ class TestAnalysis(unittest.TestCase):
         self.assertAlmostEqual(weights[1,1], 0.1731198)
 
 
+    def test_ensemble_transform_weights_eigh(self):
+        ##compare to the svd solution, for both nlobs<nens and nlobs>=nens
+        rng = np.random.default_rng(3)
+        nens = 8
+        for nlobs in (1, 3, 7, 8, 20):
+            obs = rng.normal(size=nlobs)
+            obs_err = rng.uniform(0.5, 1.5, nlobs)
+            obs_prior = rng.normal(size=(nens, nlobs))
+            lfactor = rng.uniform(0, 1, nlobs)
+            for filter_type in ('ETKF', 'DEnKF'):
+                weights = ensemble_transform_weights(obs, obs_err, obs_prior, filter_type, lfactor)
+                weights_ref = svd_transform_weights(obs, obs_err, obs_prior, filter_type, lfactor)
+                self.assertTrue(np.allclose(weights, weights_ref))
+        ##rank-deficient S with identical obs priors
+        obs_prior = np.repeat(rng.normal(size=(nens, 1)), 3, axis=1)
+        weights = ensemble_transform_weights(np.zeros(3), np.ones(3), obs_prior, 'ETKF', np.ones(3))
+        self.assertTrue(np.allclose(weights, svd_transform_weights(np.zeros(3), np.ones(3), obs_prior, 'ETKF', np.ones(3))))
+
+
+    def test_local_analysis_loop(self):
+        ##the jitted kernels give the same analysis as local_analysis for each location
+        rng = np.random.default_rng(0)
+        nens, nfld, nloc, nlobs = 6, 3, 50, 30
+        state_prior = rng.normal(size=(nens, nfld, nloc))
+        state_x, state_y = rng.uniform(0, 10, nloc), rng.uniform(0, 10, nloc)
+        state_z, state_t = rng.uniform(0, 2, (nfld, nloc)), np.zeros(nfld)
+        obs_x, obs_y, obs_z = rng.uniform(0, 10, nlobs), rng.uniform(0, 10, nlobs), rng.uniform(0, 2, nlobs)
+        obs_t = np.zeros(nlobs)
+        obs, obs_err = rng.normal(size=nlobs), np.ones(nlobs)
+        obs_prior = rng.normal(size=(nens, nlobs))
+        hroi, vroi, troi = np.full(nlobs, 4.), np.full(nlobs, 3.), np.ones(nlobs)
+        args = (state_t, obs, obs_err, obs_x, obs_y, obs_z, obs_t, obs_prior, hroi, vroi, troi)
+
+        state_ref = state_prior.copy()
+        for l in range(nloc):
+            local_analysis(state_ref[:, :, l], state_x[l], state_y[l], state_z[:, l], *args, 1, 'GC', 'ETKF')
+        self.assertFalse(np.allclose(state_ref, state_prior))
+        obs_bins = build_obs_bins(obs_x, obs_y, 4.)
+        for kernel in (local_analysis_loop, local_analysis_loop_parallel):
+            state = state_prior.copy()
+            kernel(state, state_x, state_y, state_z, *args, obs_bins, 1, 'GC', 'ETKF')
+            self.assertTrue(np.allclose(state, state_ref))
+
+
+    def test_local_analysis_blas3(self):
+        rng = np.random.default_rng(4)
+        nens, nfld, nloc, nlobs = 6, 3, 40, 30
+        state_data = {'state_prior': rng.normal(size=(nens, nfld, nloc)),
+                      'x': rng.uniform(0, 10, nloc), 'y': rng.uniform(0, 10, nloc),
+                      'z': rng.uniform(0, 2, (nfld, nloc)), 't': np.zeros(nfld)}
+        state_data['state_prior'][:, 1, 0] = 1.  ##zero spread, not updated
+        state_data['z'][2] = state_data['z'][0]   ##fields 0 and 2 share the problems
+        obs_data = {'obs': rng.normal(size=nlobs), 'err_std': np.ones(nlobs),
+                    'x': rng.uniform(0, 10, nlobs), 'y': rng.uniform(0, 10, nlobs),
+                    'z': rng.uniform(0, 2, nlobs), 't': np.zeros(nlobs),
+                    'obs_prior': rng.normal(size=(nens, nlobs)),
+                    'hroi': np.full(nlobs, 3.), 'vroi': np.full(nlobs, 3.), 'troi': np.ones(nlobs)}
+        obs_bins = build_obs_bins(obs_data['x'], obs_data['y'], 3.)
+        for filter_type in ('ETKF', 'DEnKF'):
+            state_ref = state_data['state_prior'].copy()
+            for l in range(nloc):
+                local_analysis(state_ref[:, :, l], state_data['x'][l], state_data['y'][l], state_data['z'][:, l], state_data['t'],
+                               obs_data['obs'], obs_data['err_std'], obs_data['x'], obs_data['y'], obs_data['z'], obs_data['t'],
+                               obs_data['obs_prior'], obs_data['hroi'], obs_data['vroi'], obs_data['troi'], 1, 'GC', filter_type)
+            ##batches of one point (nlobs_max below nens) and of many points
+            for batch_mem in (1e-6, 1.):
+                c = SimpleNamespace(blas3_batch_mem=batch_mem, localize_type='GC', filter_type=filter_type)
+                data = dict(state_data, state_prior=state_data['state_prior'].copy())
+                local_analysis_blas3(c, data, obs_data, obs_bins)
+                self.assertTrue(np.allclose(data['state_prior'], state_ref))
+
+
+    def test_batch_transform_weights_failure(self):
+        rng = np.random.default_rng(5)
+        nprob, nlobs, nens = 5, 8, 6
+        S, dy = rng.normal(size=(nprob, nlobs, nens)), rng.normal(size=(nprob, nlobs))
+        ref = batch_transform_weights(S, dy, 'ETKF')
+
+        ##eigh fails for any stack that contains problem 2
+        eigh = np.linalg.eigh
+        def failing_eigh(a):
+            if np.isnan(a).any():
+                raise np.linalg.LinAlgError('eigh did not converge')
+            return eigh(a)
+        S[2, 0, 0] = np.nan
+        with mock.patch.object(np.linalg, 'eigh', failing_eigh):
+            weights = batch_transform_weights(S, dy, 'ETKF')
+        self.assertTrue(np.allclose(weights[2], np.eye(nens)))
+        for b in (0, 1, 3, 4):
+            self.assertTrue(np.allclose(weights[b], ref[b]))
+
+
+    def test_nearby_obs(self):
+        rng = np.random.default_rng(1)
+        obs_x, obs_y = rng.uniform(0, 100, 500), rng.uniform(-50, 20, 500)
+        for dbin in (7., np.inf):
+            obs_bins = build_obs_bins(obs_x, obs_y, dbin)
+            for x, y in rng.uniform(-10, 110, (20, 2)):
+                ind = nearby_obs(x, y, obs_bins)
+                self.assertTrue((np.diff(ind) > 0).all())
+                ##all obs within dbin are found
+                near = np.where(np.hypot(obs_x - x, obs_y - y) < dbin)[0]
+                self.assertTrue(np.isin(near, ind).all())
+
+
+    def test_local_analysis_interp(self):
+        rng = np.random.default_rng(2)
+        ny, nx, nens, nfld, nlobs = 12, 15, 6, 3, 60
+        mask = np.full((ny, nx), False)
+        mask[5:7, 9:12] = True
+        c = SimpleNamespace(nx=nx, ny=ny, partitions=[(0, nx, 1, 0, ny, 1)], weight_interp_stride=1,
+                            state_index={'par_inds':{0: np.flatnonzero(~mask)}})
+        yy, xx = np.mgrid[0:ny, 0:nx].astype(float)
+        state_x, state_y = xx[~mask], yy[~mask]
+        nloc = state_x.size
+        state_prior = rng.normal(size=(nens, nfld, nloc))
+        state_z, state_t = np.zeros((nfld, nloc)), np.zeros(nfld)
+        state_z[2] = 0.5  ##fields 0 and 1 share the node weights, field 2 does not
+        obs_x, obs_y = rng.uniform(-5, nx+5, nlobs), rng.uniform(-5, ny+5, nlobs)
+        obs_z, obs_t = np.zeros(nlobs), np.zeros(nlobs)
+        obs, obs_err = rng.normal(size=nlobs), np.ones(nlobs)
+        obs_prior = rng.normal(size=(nens, nlobs))
+        hroi, vroi, troi = np.full(nlobs, 30.), np.ones(nlobs), np.ones(nlobs)
+        args = (state_t, obs, obs_err, obs_x, obs_y, obs_z, obs_t, obs_prior, hroi, vroi, troi)
+        obs_bins = build_obs_bins(obs_x, obs_y, 30.)
+
+        state_ref = state_prior.copy()
+        for l in range(nloc):
+            local_analysis(state_ref[:, :, l], state_x[l], state_y[l], state_z[:, l], *args, 1, 'GC', 'ETKF')
+
+        ##stride 1: every point is a node, same as local_analysis
+        state = state_prior.copy()
+        local_analysis_interp(state, state_x, state_y, state_z, *args, obs_bins, *weight_interp_stencil(c, 0), 'GC', 'ETKF')
+        self.assertTrue(np.allclose(state, state_ref))
+
+        c.weight_interp_stride = 3
+        nodes, stencil, wx, wy = weight_interp_stencil(c, 0)
+        state = state_prior.copy()
+        local_analysis_interp(state, state_x, state_y, state_z, *args, obs_bins, nodes, stencil, wx, wy, 'GC', 'ETKF')
+        ##exact at the nodes and where the stencil has masked nodes
+        exact = np.union1d(nodes, np.where(stencil[:, 0] < 0)[0])
+        self.assertTrue(np.allclose(state[..., exact], state_ref[..., exact]))
+        self.assertTrue((stencil[:, 0] < 0).any())
+        ##small error elsewhere compared to the increments, if the stride is small compared to hroi
+        err = np.abs(state - state_ref).max()
+        incr = np.abs(state_ref - state_prior).max()
+        self.assertTrue(0 < err < 0.02 * incr)
+
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -0,0 +1,50 @@
+import numpy as np
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+from datetime import datetime
+from utils.parallel import DummyComm
+from assim_tools.state import build_state_index, open_state_file, write_state_info, write_field
+from assim_tools.inflation import inflate_state, adaptive_prior_inflation
+
+class TestInflation(unittest.TestCase):
+
+    def test_inflate_state_dtype(self):
+        ##'float' state fields stay float32 after inflation with an adaptive (np.float64) coef
+        rng = np.random.default_rng(0)
+        ny, nx, nens, nobs = 5, 6, 4, 50
+        mask = np.full((ny, nx), False)
+        mask[0, :2] = True
+        info = {'nx':nx, 'ny':ny, 'size':np.sum(~mask)*8, 'fields':{0:{'name':'t', 'model_src':'qg', 'dtype':'double',
+                'is_vector':False, 'units':'K', 'err_type':'normal', 'time':datetime(2023,1,1), 'dt':0, 'k':0, 'pos':0}}}
+        c = SimpleNamespace(comm=DummyComm(), comm_mem=DummyComm(), pid_mem=0, pid_rec=0, nproc_mem=1, pid_show=0, debug=False,
+                            nx=nx, ny=ny, nens=nens, mask=mask, state_info=info, state_dtype='float',
+                            mem_list={0:list(range(nens))}, rec_list={0:[0]}, obs_rec_list={0:[0]},
+                            obs_info={'records':{0:{'is_vector':False, 'nobs':nobs}}})
+        c.partitions = [(0, nx, 1, 0, ny, 1)]
+        c.state_index = build_state_index(c)
+
+        obs_prior_seq = {(m, 0): rng.normal(size=nobs) for m in range(nens)}
+        obs_seq = {0: {'obs': rng.normal(0, 3, size=nobs), 'err_std': np.ones(nobs)}}
+        adaptive_prior_inflation(c, obs_seq, obs_prior_seq)
+        self.assertIsInstance(c.inflate_coef, np.float64)
+
+        fields = {(m, 0): rng.normal(280, 0.05, (ny, nx)).astype(np.float32) for m in range(nens)}
+        mean = np.mean([fld for fld in fields.values()], axis=0, dtype=np.float64)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            mean_file = os.path.join(tmpdir, 'mean.bin')
+            open_state_file(mean_file, info, 'w+', 1).flush()
+            write_state_info(mean_file, info, mask, 1)
+            write_field(mean_file, info, mask, 0, 0, mean)
+            fields0 = {key: fld.copy() for key, fld in fields.items()}
+            inflate_state(c, fields, mean_file)
+
+        for key, fld in fields.items():
+            self.assertEqual(fld.dtype, np.float32)
+            fld0 = fields0[key].astype(np.float64)
+            np.testing.assert_allclose(fld[~mask], (c.inflate_coef*(fld0 - mean) + mean)[~mask], rtol=1e-6)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,7 @@
 ##check if your mpi environment is correctly setup
 import numpy as np
 import unittest
-from utils.parallel import Comm, distribute_tasks
+from utils.parallel import Comm, distribute_tasks, CommStats, StatsComm, msg_nbytes
 
 class TestParallel(unittest.TestCase):
 
@@ -65,6 +65,29 @@ class TestParallel(unittest.TestCase):
             self.assertTrue((np.array(gather_data) == np.arange(nproc)).all())
 
 
+    def test_buffer_reduce(self):
+        comm = Comm()
+        pid = comm.Get_rank()
+        nproc = comm.Get_size()
+        sendbuf = np.full((2, 3), pid+1.)
+        recvbuf = np.empty_like(sendbuf) if pid == 0 else None
+        comm.Reduce(sendbuf, recvbuf, root=0)
+        if pid == 0:
+            self.assertTrue((recvbuf == nproc*(nproc+1)/2).all())
+
+
+    def test_comm_stats(self):
+        self.assertEqual(msg_nbytes({0: np.zeros(10), 1: [np.zeros((2, 5), dtype=np.float32)]}), 120)
+        stats = CommStats()
+        comm = StatsComm(Comm(), stats)
+        comm.allgather(np.zeros(10))
+        stats.section = 'test'
+        comm.Split(0, comm.Get_rank()).Barrier()
+        self.assertEqual(stats.records['other']['allgather']['bytes'], 80)
+        self.assertEqual(stats.records['other']['allgather']['messages'], 1)
+        self.assertEqual(stats.records['test']['Barrier']['messages'], 1)
+
+
     def test_distribute_tasks(self):
         comm = Comm()
         pid = comm.Get_rank()
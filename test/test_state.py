@@ -0,0 +1,195 @@
+import numpy as np
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+from datetime import datetime
+from utils.parallel import Comm, DummyComm
+from assim_tools.state import write_state_info, read_state_info, mask_checksum, open_state_file, write_field, read_field
+from assim_tools.state import bitround, write_fields_compressed, CompressedStateFile, build_state_index, StateFileFields
+from assim_tools.state import output_ens_mean, read_header
+
+class TestState(unittest.TestCase):
+
+    def setUp(self):
+        ny, nx = 10, 12
+        self.mask = np.full((ny, nx), False, dtype=bool)
+        self.mask[3:5, 4:9] = True
+        fld_size = np.sum(~self.mask)
+        self.info = {'nx':nx, 'ny':ny, 'size':0, 'fields':{}}
+        pos = 0
+        for rec_id, (name, dtype, is_vector) in enumerate([('u', 'float', True), ('t', 'double', False), ('s', 'float', False)]):
+            self.info['fields'][rec_id] = {'name':name, 'model_src':'qg', 'dtype':dtype,
+                                           'is_vector':is_vector, 'units':'*', 'err_type':'normal',
+                                           'time':datetime(2023,1,1), 'dt':0, 'k':0, 'pos':pos}
+            pos += (2 if is_vector else 1) * fld_size * (8 if dtype=='double' else 4)
+        self.info['size'] = pos
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.binfile = os.path.join(self.tmpdir.name, 'state.bin')
+
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+
+    def random_field(self, rec_id):
+        rec = self.info['fields'][rec_id]
+        shape = (2, self.info['ny'], self.info['nx']) if rec['is_vector'] else (self.info['ny'], self.info['nx'])
+        return np.random.normal(0, 1, shape)
+
+
+    def test_write_read_field(self):
+        nens = 3
+        open_state_file(self.binfile, self.info, 'w+', nens).flush()
+        write_state_info(self.binfile, self.info, self.mask, nens)
+        self.assertEqual(os.path.getsize(self.binfile), nens*self.info['size'])
+
+        flds = {}
+        f = open_state_file(self.binfile, self.info, 'r+')
+        for mem_id in range(nens):
+            for rec_id, rec in self.info['fields'].items():
+                flds[mem_id, rec_id] = self.random_field(rec_id)
+                write_field(f, self.info, self.mask, mem_id, rec_id, flds[mem_id, rec_id])
+        f.flush()
+        del f
+
+        info = read_state_info(self.binfile)
+        self.assertEqual(info['nens'], nens)
+        self.assertEqual(info['mask_checksum'], mask_checksum(self.mask))
+        for (mem_id, rec_id), fld in flds.items():
+            fld1 = read_field(self.binfile, info, self.mask, mem_id, rec_id)
+            self.assertTrue(np.isnan(fld1[..., self.mask]).all())
+            if info['fields'][rec_id]['dtype'] == 'double':
+                self.assertTrue((fld1[..., ~self.mask] == fld[..., ~self.mask]).all())
+            else:
+                self.assertTrue(np.allclose(fld1[..., ~self.mask], fld[..., ~self.mask], atol=1e-6))
+
+
+    def test_state_info_header(self):
+        self.info['fields'][1]['units'] = 'deg C'  ##units with space
+        write_state_info(self.binfile, self.info, self.mask, 2)
+        info = read_state_info(self.binfile)
+        self.assertEqual(info['size'], self.info['size'])
+        self.assertEqual(info['fld_size'], np.sum(~self.mask))
+        for rec_id, rec in self.info['fields'].items():
+            for key in rec.keys():
+                self.assertEqual(info['fields'][rec_id][key], rec[key])
+            nv = 2 if rec['is_vector'] else 1
+            self.assertEqual(info['fields'][rec_id]['nbytes'], nv*np.sum(~self.mask)*(8 if rec['dtype']=='double' else 4))
+
+
+    def test_build_state_index(self):
+        ny, nx = self.mask.shape
+        c = SimpleNamespace(nx=nx, ny=ny, mask=self.mask, state_info=self.info,
+                            partitions=[(0, 6, 1, 0, 5, 1), (6, nx, 1, 0, 5, 1), (0, nx, 2, 5, ny, 1)])
+        index = build_state_index(c)
+        self.assertEqual(index['fld_size'], np.sum(~self.mask))
+        fld = np.random.normal(0, 1, (ny, nx))
+        self.assertTrue((fld.reshape(-1)[index['inds']] == fld[~self.mask]).all())
+        for par_id, (ist,ied,di,jst,jed,dj) in enumerate(c.partitions):
+            msk = self.mask[jst:jed:dj, ist:ied:di]
+            self.assertEqual(index['par_size'][par_id], np.sum(~msk))
+            self.assertTrue((fld.reshape(-1)[index['par_inds'][par_id]] == fld[jst:jed:dj, ist:ied:di][~msk]).all())
+
+
+    def test_bitround(self):
+        x = np.random.normal(0, 1, 1000)
+        for keepbits in (5, 10, 20):
+            xr = bitround(x.copy(), keepbits)
+            self.assertTrue((np.abs(xr - x) <= np.abs(x) * 2.**-(keepbits+1)).all())
+        self.assertTrue((bitround(x.copy(), 0) == x).all())
+
+
+    def test_compressed_state_file(self):
+        ##under mpi, each pid writes its own members to the file created by pid 0
+        comm = Comm()
+        c = SimpleNamespace(comm=comm, pid=comm.Get_rank(), nx=self.info['nx'], ny=self.info['ny'], mask=self.mask, state_info=self.info,
+                            state_file_compress='zlib', state_file_keepbits=0, state_file_downcast=False)
+        c.partitions = [(0, c.nx, 1, 0, c.ny, 1)]
+        c.state_index = build_state_index(c)
+        nproc = comm.Get_size()
+        nens = nproc + 1
+        binfile = comm.bcast(self.binfile if c.pid == 0 else None, root=0)
+        flds = {}
+        for m in range(nens):
+            np.random.seed(m)
+            for r in self.info['fields'].keys():
+                flds[m, r] = self.random_field(r)
+        write_fields_compressed(c, {(m, r): fld for (m, r), fld in flds.items() if m % nproc == c.pid}, binfile, nens)
+
+        f = open_state_file(binfile, self.info)
+        self.assertIsInstance(f, CompressedStateFile)
+        self.assertEqual(read_state_info(binfile)['compress'], 'zlib')
+        for (mem_id, rec_id), fld in flds.items():
+            fld1 = read_field(f, self.info, self.mask, mem_id, rec_id)
+            self.assertTrue(np.isnan(fld1[..., self.mask]).all())
+            dtype = np.float64 if self.info['fields'][rec_id]['dtype']=='double' else np.float32
+            self.assertTrue((fld1[..., ~self.mask] == fld[..., ~self.mask].astype(dtype)).all())
+        del f
+        ##the file is removed with the tmpdir of pid 0
+        comm.Barrier()
+
+
+    def test_compressed_state_file_lossless(self):
+        c = SimpleNamespace(comm=DummyComm(), pid=0, nx=self.info['nx'], ny=self.info['ny'], mask=self.mask, state_info=self.info,
+                            state_file_compress='zlib', state_file_keepbits=4, state_file_downcast=True)
+        c.partitions = [(0, c.nx, 1, 0, c.ny, 1)]
+        c.state_index = build_state_index(c)
+        flds = {(0, r): self.random_field(r) for r in self.info['fields'].keys()}
+        write_fields_compressed(c, flds, self.binfile, 1, lossless=True)
+
+        self.assertEqual(read_header(self.binfile)['keepbits'], 0)
+        info = read_state_info(self.binfile)
+        f = open_state_file(self.binfile, self.info)
+        for (mem_id, rec_id), fld in flds.items():
+            self.assertEqual(info['fields'][rec_id]['dtype'], self.info['fields'][rec_id]['dtype'])
+            fld1 = read_field(f, self.info, self.mask, mem_id, rec_id)
+            dtype = np.float64 if self.info['fields'][rec_id]['dtype']=='double' else np.float32
+            self.assertTrue((fld1[..., ~self.mask] == fld[..., ~self.mask].astype(dtype)).all())
+
+
+    def test_state_file_fields(self):
+        nens = 3
+        open_state_file(self.binfile, self.info, 'w+', nens).flush()
+        flds = {(m, r): self.random_field(r) for m in range(nens) for r in self.info['fields'].keys()}
+        for (mem_id, rec_id), fld in flds.items():
+            write_field(self.binfile, self.info, self.mask, mem_id, rec_id, fld)
+        c = SimpleNamespace(nx=self.info['nx'], ny=self.info['ny'], mask=self.mask, state_info=self.info,
+                            state_dtype='double', pid_mem=0, pid_rec=0, mem_list={0:[1, 2]}, rec_list={0:[0, 1]})
+        c.partitions = [(0, c.nx, 1, 0, c.ny, 1)]
+        c.state_index = build_state_index(c)
+        fields = StateFileFields(c, self.binfile)
+        self.assertEqual(fields.keys(), [(1, 0), (1, 1), (2, 0), (2, 1)])
+        self.assertNotIn((0, 0), fields)
+        self.assertRaises(KeyError, fields.__getitem__, (1, 2))
+        fld1 = fields[2, 1]  ##rec 1 is stored as double
+        self.assertTrue((fld1[..., ~self.mask] == flds[2, 1][..., ~self.mask]).all())
+
+
+    def test_output_ens_spread(self):
+        ##float32 members with a large offset and small spread, as temperature in K
+        nens = 20
+        comm = DummyComm()
+        c = SimpleNamespace(comm=comm, comm_mem=comm, pid=0, pid_mem=0, pid_rec=0, pid_show=0, debug=False,
+                            nx=self.info['nx'], ny=self.info['ny'], nens=nens, mask=self.mask, state_info=self.info,
+                            mem_list={0:list(range(nens))}, rec_list={0:list(self.info['fields'].keys())},
+                            ens_mean_batch_size=2, state_file_compress='none')
+        c.partitions = [(0, c.nx, 1, 0, c.ny, 1)]
+        c.state_index = build_state_index(c)
+        flds = {(m, r): (280 + 0.05*self.random_field(r)).astype(np.float32)
+                for m in range(nens) for r in self.info['fields'].keys()}
+        mean_file = os.path.join(self.tmpdir.name, 'mean.bin')
+        spread_file = os.path.join(self.tmpdir.name, 'spread.bin')
+        output_ens_mean(c, flds, mean_file, spread_file)
+
+        for rec_id, rec in self.info['fields'].items():
+            ens = np.array([flds[m, rec_id] for m in range(nens)], dtype=np.float64)
+            mean = read_field(mean_file, self.info, self.mask, 0, rec_id)
+            spread = read_field(spread_file, self.info, self.mask, 0, rec_id)
+            rtol = 1e-12 if rec['dtype']=='double' else 1e-5
+            np.testing.assert_allclose(mean[..., ~self.mask], np.mean(ens, axis=0)[..., ~self.mask], rtol=rtol)
+            np.testing.assert_allclose(spread[..., ~self.mask], np.std(ens, axis=0, ddof=1)[..., ~self.mask], rtol=rtol)
+
+
+if __name__ == '__main__':
+    unittest.main()
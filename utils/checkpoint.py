@@ -0,0 +1,84 @@
+import numpy as np
+import os
+import json
+import pickle
+import hashlib
+import shutil
+from functools import wraps
+from utils.conversion import t2s
+
+"""
+Checkpoint/resume for the analysis steps in scripts/assimilate.py
+
+With c.checkpoint = True, the output of each decorated stage is saved by every
+pid to its own file, so that if the job dies, a restart with the same config
+loads the saved outputs and skips the stages already completed.
+The files are stored under analysis_dir/checkpoint/<config hash>, so that
+changing the config (or the number of processors) starts from scratch.
+The directory is found once by checkpoint_dir() at the start of the run and
+kept in c.checkpoint_dir, since some config values (relax_coef, inflate_coef
+with adaptive inflation) are changed by the analysis partway through the run.
+"""
+
+def config_hash(c):
+    """
+    Hash of the config values (in c.keys) and the processor layout, identifying
+    a run whose checkpoints can be reused
+    """
+    config_dict = {key: getattr(c, key) for key in c.keys}
+    config_dict['nproc'] = c.nproc
+    config_dict['nproc_mem'] = c.nproc_mem
+    s = json.dumps(config_dict, sort_keys=True, default=str)
+    return hashlib.sha1(s.encode()).hexdigest()[:16]
+
+
+def checkpoint_dir(c):
+    """directory storing the checkpoint files for the current cycle"""
+    return os.path.join(c.work_dir, 'cycle', t2s(c.time), 'analysis', c.s_dir, 'checkpoint', config_hash(c))
+
+
+def checkpoint(c, name):
+    """
+    Decorator to save the result of func() to a checkpoint file for stage name,
+    or load the result from the file if the stage is completed by all pids
+
+    Inputs:
+    - c: config object, the decorator does nothing if c.checkpoint is False
+    - name: str, name of the stage
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not c.checkpoint:
+                return func(*args, **kwargs)
+
+            ckpt_dir = c.checkpoint_dir
+            ckpt_file = os.path.join(ckpt_dir, f'{name}.{c.pid}.pkl')
+
+            ##the stage is only skipped if all pids have their checkpoint file
+            if all(c.comm.allgather(os.path.exists(ckpt_file))):
+                with open(ckpt_file, 'rb') as f:
+                    result = pickle.load(f)
+                if c.pid == c.pid_show:
+                    print(f"checkpoint: {name} loaded from {ckpt_dir}\n", flush=True)
+                return result
+
+            result = func(*args, **kwargs)
+
+            ##write to a temporary file first, so that a job killed during
+            ##output doesn't leave a partial checkpoint file behind
+            os.makedirs(ckpt_dir, exist_ok=True)
+            with open(ckpt_file+'.tmp', 'wb') as f:
+                pickle.dump(result, f, protocol=5)
+            os.replace(ckpt_file+'.tmp', ckpt_file)
+            return result
+        return wrapper
+    return decorator
+
+
+def clean_checkpoint(c):
+    """remove the checkpoint files once the analysis is completed"""
+    if c.checkpoint:
+        c.comm.Barrier()
+        if c.pid == 0:
+            shutil.rmtree(c.checkpoint_dir, ignore_errors=True)
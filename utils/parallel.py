@@ -1,9 +1,11 @@
 import numpy as np
 import os
+import sys
 from functools import wraps
 import time
 from concurrent.futures import ThreadPoolExecutor
 import threading
+import json
 from utils.progress import print_with_cache, progress_bar
 
 class Comm(object):
@@ -60,12 +62,234 @@ class DummyComm(object):
     def gather(self, obj, root=0):
         return obj
 
+    def scatter(self, obj, root=0):
+        return obj[0]
+
     def allreduce(self, obj):
         return obj
 
     def reduce(self, obj, root=0):
         return obj
 
+    def Reduce(self, sendbuf, recvbuf, op=None, root=0):
+        recvbuf[...] = sendbuf
+
+    def Allreduce(self, sendbuf, recvbuf, op=None):
+        recvbuf[...] = sendbuf
+
+
+def mpi_comm(comm):
+    """
+    Get the mpi4py communicator behind comm, for calls (MPI-IO, etc.)
+    that need the actual MPI object; returns None if comm is a DummyComm
+    """
+    while isinstance(comm, (Comm, StatsComm)):
+        comm = comm._comm
+    if isinstance(comm, DummyComm):
+        return None
+    return comm
+
+
+def msg_nbytes(obj):
+    """
+    Approximate size in bytes of a message obj: the data size of arrays,
+    summed over the items of dict/list/tuple, without pickling obj
+    """
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, dict):
+        return sum(msg_nbytes(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(msg_nbytes(v) for v in obj)
+    return sys.getsizeof(obj)
+
+
+class CommStats(object):
+    """
+    Communication statistics of a processor: number of bytes, number of messages
+    and time spent (waiting) in the calls, accumulated for each (section, call)
+    """
+    def __init__(self):
+        self.section = 'other'
+        self.records = {}
+
+    def add(self, call, nbytes, nmsg, wait):
+        rec = self.records.setdefault(self.section, {}).setdefault(call, {'bytes':0, 'messages':0, 'time':0.0})
+        rec['bytes'] += int(nbytes)
+        rec['messages'] += nmsg
+        rec['time'] += wait
+
+
+class StatsComm(object):
+    """
+    Communicator wrapper recording in stats (CommStats) the bytes, messages
+    and time of each communication call; other attributes go to the wrapped comm.
+    Isend/Irecv only record the time to post the request, the time waiting
+    for the requests to complete is not included.
+    """
+    def __init__(self, comm, stats):
+        self._comm = comm
+        self.stats = stats
+
+    def __getattr__(self, attr):
+        return getattr(self._comm, attr)
+
+    def _call(self, call, nbytes, func, *args, **kwargs):
+        t0 = time.time()
+        result = func(*args, **kwargs)
+        if nbytes is None:  ##received message, size known after the call
+            nbytes = msg_nbytes(result)
+        self.stats.add(call, nbytes, 1, time.time()-t0)
+        return result
+
+    def send(self, obj, *args, **kwargs):
+        return self._call('send', msg_nbytes(obj), self._comm.send, obj, *args, **kwargs)
+
+    def recv(self, *args, **kwargs):
+        return self._call('recv', None, self._comm.recv, *args, **kwargs)
+
+    def Send(self, buf, *args, **kwargs):
+        return self._call('Send', msg_nbytes(buf), self._comm.Send, buf, *args, **kwargs)
+
+    def Recv(self, buf, *args, **kwargs):
+        return self._call('Recv', msg_nbytes(buf), self._comm.Recv, buf, *args, **kwargs)
+
+    def Isend(self, buf, *args, **kwargs):
+        return self._call('Isend', msg_nbytes(buf), self._comm.Isend, buf, *args, **kwargs)
+
+    def Irecv(self, buf, *args, **kwargs):
+        return self._call('Irecv', msg_nbytes(buf), self._comm.Irecv, buf, *args, **kwargs)
+
+    def bcast(self, obj, *args, **kwargs):
+        return self._call('bcast', None, self._comm.bcast, obj, *args, **kwargs)
+
+    def allgather(self, obj):
+        return self._call('allgather', msg_nbytes(obj), self._comm.allgather, obj)
+
+    def gather(self, obj, *args, **kwargs):
+        return self._call('gather', msg_nbytes(obj), self._comm.gather, obj, *args, **kwargs)
+
+    def scatter(self, obj, *args, **kwargs):
+        return self._call('scatter', None, self._comm.scatter, obj, *args, **kwargs)
+
+    def allreduce(self, obj, *args, **kwargs):
+        return self._call('allreduce', msg_nbytes(obj), self._comm.allreduce, obj, *args, **kwargs)
+
+    def reduce(self, obj, *args, **kwargs):
+        return self._call('reduce', msg_nbytes(obj), self._comm.reduce, obj, *args, **kwargs)
+
+    def Reduce(self, sendbuf, *args, **kwargs):
+        return self._call('Reduce', msg_nbytes(sendbuf), self._comm.Reduce, sendbuf, *args, **kwargs)
+
+    def Allreduce(self, sendbuf, *args, **kwargs):
+        return self._call('Allreduce', msg_nbytes(sendbuf), self._comm.Allreduce, sendbuf, *args, **kwargs)
+
+    def Alltoallv(self, sendbuf, *args, **kwargs):
+        ##sendbuf is given as [buf, (counts, displs)]
+        buf, (counts, _) = sendbuf
+        return self._call('Alltoallv', np.sum(counts)*buf.itemsize, self._comm.Alltoallv, sendbuf, *args, **kwargs)
+
+    def Barrier(self):
+        return self._call('Barrier', 0, self._comm.Barrier)
+
+    def Split(self, *args, **kwargs):
+        return StatsComm(self._comm.Split(*args, **kwargs), self.stats)
+
+    def Dup(self):
+        return StatsComm(self._comm.Dup(), self.stats)
+
+
+def instrument_comm(c):
+    """
+    Replace the communicators c.comm, c.comm_mem, c.comm_rec with StatsComm
+    sharing the same statistics c.comm_log (CommStats)
+    """
+    c.comm_log = CommStats()
+    c.comm = StatsComm(c.comm, c.comm_log)
+    c.comm_mem = StatsComm(c.comm_mem, c.comm_log)
+    c.comm_rec = StatsComm(c.comm_rec, c.comm_log)
+
+
+def comm_section(c, name):
+    """
+    Decorator to record the communication in func() under section name,
+    if c.comm_stats is True
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not c.comm_stats:
+                return func(*args, **kwargs)
+            prev_section = c.comm_log.section
+            c.comm_log.section = name
+            try:
+                return func(*args, **kwargs)
+            finally:
+                c.comm_log.section = prev_section
+        return wrapper
+    return decorator
+
+
+def report_comm_stats(c, json_file):
+    """
+    Gather the communication statistics from all processors, show a table
+    of total bytes, messages and time (max over pid) per section and call,
+    and save the per-pid statistics to json_file
+    """
+    ##gather with the wrapped comm, so that the gather itself is not recorded
+    comm = c.comm._comm if isinstance(c.comm, StatsComm) else c.comm
+    all_records = comm.gather(c.comm_log.records, root=0)
+    if c.pid != 0:
+        return
+    if not isinstance(all_records, list):  ##DummyComm.gather
+        all_records = [all_records]
+
+    total = {}
+    for records in all_records:
+        for section, calls in records.items():
+            for call, rec in calls.items():
+                tot = total.setdefault(section, {}).setdefault(call, {'bytes':0, 'messages':0, 'time_max':0.0, 'time_sum':0.0})
+                tot['bytes'] += rec['bytes']
+                tot['messages'] += rec['messages']
+                tot['time_max'] = max(tot['time_max'], rec['time'])
+                tot['time_sum'] += rec['time']
+
+    print('communication statistics:')
+    print(f"{'section':<28} {'call':<10} {'MB':>12} {'messages':>10} {'max time(s)':>12} {'mean time(s)':>12}")
+    for section in sorted(total.keys()):
+        for call in sorted(total[section].keys()):
+            tot = total[section][call]
+            print(f"{section:<28} {call:<10} {tot['bytes']/2**20:12.2f} {tot['messages']:10d} {tot['time_max']:12.3f} {tot['time_sum']/len(all_records):12.3f}")
+    print('', flush=True)
+
+    with open(json_file, 'w') as f:
+        json.dump({'total': total, 'pid': all_records}, f, indent=1)
+
+
+def node_ids(comm):
+    """
+    Find which compute node each rank in comm is on, using a shared-memory
+    split (MPI.COMM_TYPE_SHARED) of comm
+
+    Inputs:
+    - comm: mpi communicator
+
+    Return:
+    - node: dict[rank, int]
+      Node index for each rank in comm, nodes are numbered in order of their lowest rank
+    """
+    mpicomm = mpi_comm(comm)
+    if mpicomm is None:
+        return {0: 0}
+    from mpi4py import MPI
+    node_comm = mpicomm.Split_type(MPI.COMM_TYPE_SHARED)
+    ##the lowest rank on each node identifies the node
+    leader = node_comm.allreduce(mpicomm.Get_rank(), op=MPI.MIN)
+    node_comm.Free()
+    leaders = mpicomm.allgather(leader)
+    uniq_leaders = sorted(set(leaders))
+    return {r: uniq_leaders.index(l) for r, l in enumerate(leaders)}
+
 
 def by_rank(comm, rank):
     """
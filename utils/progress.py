@@ -1,6 +1,7 @@
 import numpy as np
 import shutil
 import time
+import resource
 from functools import wraps
 
 def timer(c):
@@ -69,3 +70,14 @@ def print_with_cache(msg):
         print(msg, flush=True, end="")
         print_with_cache.prev_msg = msg
 
+
+
+def peak_memory(c):
+    """
+    Show the peak resident set size (RSS) of the processors in c.comm,
+    the max over pid and the total, in MB
+    """
+    ##ru_maxrss is in kilobytes on linux
+    rss = c.comm.allgather(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+    if c.comm.Get_rank() == c.pid_show:
+        print(f"peak memory: max {np.max(rss):.1f} MB per processor, total {np.sum(rss):.1f} MB\n", flush=True)